@@ -1,13 +1,80 @@
 import os, sys
-from flask import Flask, render_template, request, redirect, flash, redirect, url_for, Response
+from flask import Flask, render_template, request, redirect, flash, redirect, url_for, Response, abort, jsonify
 from app import app
 import pymongo
 import secrets as sec
 import nationalparks as usnp
+from nationalparks import cache
+from nationalparks.parks import get_map_renderer
 from wtforms import TextField, Form, SelectField
 import json
+import time
+import hashlib
 import folium
 
+## browser cache duration of the park maps (seconds)
+MAP_MAX_AGE = 3600
+
+## browser cache duration of the autocomplete results (seconds)
+AUTOCOMPLETE_MAX_AGE = 86400
+AUTOCOMPLETE_LIMIT = 10
+
+## pre-rendered maps (see update_database/update_maps.py)
+MAP_PATH = os.path.join(app.static_folder, 'maps')
+MAP_EXTENSIONS = {'br': '.br', 'gzip': '.gz', 'identity': ''}
+map_manifest = {'mtime': None, 'parks': {}}
+
+def load_map_manifest():
+    '''
+    Returns the manifest of the pre-rendered maps (etag and sizes per park unit), reloaded when the maps are rebuilt.
+    '''
+    manifest_file = os.path.join(MAP_PATH, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return {}
+    mtime = os.path.getmtime(manifest_file)
+    if map_manifest['mtime'] != mtime:
+        with open(manifest_file) as f:
+            map_manifest['parks'] = json.load(f)
+        map_manifest['mtime'] = mtime
+    return map_manifest['parks']
+
+def is_map_current(parkunit, entry):
+    '''
+    Returns True when a pre-rendered map (manifest entry) matches the current data and renderer:
+    same renderer and either the same data generation or the same map ETag (the park data did not change).
+    '''
+    if entry.get('renderer') != get_map_renderer():
+        return False
+    if entry.get('generation') == usnp.data_generation.get():
+        return True
+    if usnp.parks.get_park_info(parkunit) is None:
+        return False
+    return entry['etag'] == usnp.park_cache.get(parkunit).get_map_etag()
+
+def load_map(parkunit):
+    '''
+    Returns the pre-rendered map of a park using the best encoding accepted by the client.
+
+    Input:
+        parkunit (string) e.g. acad
+    Output:
+        (data, etag, encoding) or None when the map has not been rendered or is outdated
+    '''
+    entry = load_map_manifest().get(parkunit)
+    if entry is None or not is_map_current(parkunit, entry):
+        return None
+
+    ## negotiate encoding (br > gzip > identity)
+    for encoding in ['br', 'gzip', 'identity']:
+        if encoding in entry['sizes'] and (encoding == 'identity' or request.accept_encodings[encoding]):
+            break
+    filename = os.path.join(MAP_PATH, parkunit + '.html' + MAP_EXTENSIONS[encoding])
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return data, entry['etag'], encoding
+
 class SearchForm(Form):
     autocomp = TextField(None, id='park_autocomplete', description="TAD")
 
@@ -19,24 +86,72 @@ def home():
     form = SearchForm(request.form)
     return render_template("find.html", message="", form=form)
 
-@app.route('/map')
-def map():
-    return render_template('map.html')
-
-@app.route('/explore', methods=['GET'])
-def explore_park():
-
-    ## retrieve infos
-    parkname = request.args.get('autocomp')
-
-    ## validate input (i.e. check parkname in DB)
-    if not usnp.parks.is_park_in_db(parkname):
-        form = SearchForm(request.form)
-        return render_template('find.html', message="Enter a valid park name.", form=form)
+def get_park_or_404(parkunit):
+    '''
+    Returns the cached Park object of a park unit, aborts with 404 when the park does not exist
+    (unknown units are rejected by the park registry without database round trip).
+    '''
+    if usnp.parks.get_park_info(parkunit) is None:
+        abort(404)
+    try:
+        return usnp.park_cache.get(parkunit)
+    except ValueError:
+        abort(404)
+
+@app.route('/map/<parkunit>')
+def park_map(parkunit):
+    ## pre-rendered map
+    prerendered = load_map(parkunit)
+    if prerendered is not None:
+        data, etag, encoding = prerendered
+        response = Response(data, mimetype='text/html')
+        response.vary.add('Accept-Encoding')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+            etag = etag + '-' + encoding
 
-    ## create park object
-    parkunit = usnp.parks.parkname_to_parkunit(parkname)
-    park = usnp.Park(parkunit)
+    else:
+        ## map rendered once per cached park
+        park = get_park_or_404(parkunit)
+        html, etag = park.get_map_html()
+        response = Response(html, mimetype='text/html')
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = MAP_MAX_AGE
+    return response.make_conditional(request)
+
+def cached_response(key, expires, render, mimetype='text/html'):
+    '''
+    Serves a response from the response cache (rendered on miss) with its ETag, 304 when the client copy is valid.
+
+    Inputs:
+        key (tuple) cache key (e.g. endpoint, park unit, scene rank, sample seed)
+        expires (float) timestamp at which the response changes (end of the sample window)
+        render (function) returns the body of the response
+        mimetype (string)
+    '''
+    ## the response is bound to the data generation (shared entries of older data are never hit again)
+    key = key + (usnp.data_generation.get(), usnp.parks.get_version())
+    entry = usnp.response_cache.get(key)
+    if entry is None:
+        body = render()
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        entry = {'body': body, 'etag': hashlib.sha1(body).hexdigest()}
+        usnp.response_cache.set(key, entry, expires)
+
+    response = Response(entry['body'], mimetype=mimetype)
+    response.set_etag(entry['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = max(int(expires - time.time()), 0)
+    return response.make_conditional(request)
+
+def render_scene(parkname, parkunit, cluster_rank, seed):
+    '''
+    Renders the explore page of a park for the selected scene (cluster rank).
+    '''
+    park = usnp.park_cache.get(parkunit)
     photo_count = park.photo_count
 
     ## get cluster info
@@ -50,27 +165,19 @@ def explore_park():
     if cluster_count == 0:
         message = 'There are no locations to explore for this park.'
 
-    ## map
-    folium_map = park.show_park()
-    folium_map.save('app/templates/map.html')
-
     ## locations
     form = SelectForm()
     form.locationSelect.choices = [(parkname + '//' + str(i+1), 'Scene ' + str(i+1)) for i in range(cluster_count)]
 
-    ## selected clusters
-    cluster_rank = 1
-
     ## get cluster id
     cluster_id = clusters.loc[clusters['rank']==cluster_rank,'labels'].to_numpy()[0]
 
     ## photos
-    photos = park.get_top_photos(int(cluster_id), n_photos=25)
+    photos = park.get_top_photos(int(cluster_id), n_photos=25, seed=seed)
 
     ## tf-idf
     tags = park.clusters[park.clusters['rank']==cluster_rank]['top_tags'].values[0]
-    if tags:
-        tags = tags.split(";")
+    tags = tags.split(";") if isinstance(tags, str) and tags else []
 
     return render_template(
         "explore.html",
@@ -88,6 +195,27 @@ def explore_park():
         cluster_rank=cluster_rank,
         tags=tags)
 
+@app.route('/explore', methods=['GET'])
+def explore_park():
+
+    ## retrieve infos
+    parkname = request.args.get('autocomp')
+
+    ## validate input (park registry, no database round trip)
+    parkunit = usnp.parks.parkname_to_parkunit(parkname)
+    if parkunit is None:
+        form = SearchForm(request.form)
+        return render_template('find.html', message="Enter a valid park name.", form=form)
+
+    ## selected clusters
+    cluster_rank = 1
+
+    ## cached page (same photo sample during a window)
+    seed, expires = cache.get_sample_seed(parkunit, cluster_rank)
+    return cached_response(
+        ('explore', parkunit, cluster_rank, seed), expires,
+        lambda: render_scene(parkname, parkunit, cluster_rank, seed))
+
 @app.route('/update_cluster', methods=['GET','POST'])
 def update_cluster():
     results = request.args.get('locationSelect')
@@ -97,54 +225,45 @@ def update_cluster():
 
     ## create park object
     parkunit = usnp.parks.parkname_to_parkunit(parkname)
-    park = usnp.Park(parkunit)
-    photo_count = park.photo_count
-
-    ## get cluster info
-    if photo_count > 0:
-        clusters = park.clusters
-        cluster_count = clusters.shape[0]
-    else:
-        clusters, cluster_count = 0, 0
-
-    message = 'Click a scene marker to explore.'
-    if cluster_count == 0:
-        message = 'There are no locations to explore for this park.'
-
-    ## map
-    folium_map = park.show_park()
-    folium_map.save('app/templates/map.html')
-
-    ## locations
-    form = SelectForm()
-    form.locationSelect.choices = [(parkname + '//' + str(i+1), 'Scene ' + str(i+1)) for i in range(cluster_count)]
+    if parkunit is None:
+        abort(404)
+
+    ## cached page (same photo sample during a window)
+    seed, expires = cache.get_sample_seed(parkunit, cluster_rank)
+    return cached_response(
+        ('explore', parkunit, cluster_rank, seed), expires,
+        lambda: render_scene(parkname, parkunit, cluster_rank, seed))
+
+@app.route('/api/parks/<parkunit>/clusters/<int:cluster_rank>')
+def api_cluster(parkunit, cluster_rank):
+    '''
+    Returns the photos and top tags of a scene (used by the explore page to switch scenes).
+    '''
+    park = get_park_or_404(parkunit)
 
     ## get cluster id
-    cluster_id = clusters.loc[clusters['rank']==cluster_rank,'labels'].to_numpy()[0]
+    clusters = park.clusters
+    cluster = clusters[clusters['rank']==cluster_rank]
+    if cluster.empty:
+        abort(404)
+    cluster_id = cluster['labels'].to_numpy()[0]
 
-    ## photos
-    photos = park.get_top_photos(int(cluster_id), n_photos=25)
+    def render():
+        ## photos (same sample as the explore page of the scene)
+        photos = park.get_top_photos(int(cluster_id), n_photos=25, seed=seed)
 
-    ## tf-idf
-    tags = park.clusters[park.clusters['rank']==cluster_rank]['top_tags'].values[0]
-    if tags:
-        tags = tags.split(";")
+        ## tf-idf
+        tags = cluster['top_tags'].values[0]
+        tags = tags.split(";") if isinstance(tags, str) and tags else []
 
-    return render_template(
-        "explore.html",
-        parkname=parkname,
-        state=park.state,
-        parkunit=parkunit,
-        photo_count="{:,}".format(photo_count),
-        cluster_count=cluster_count,
-        description=park.description,
-        park_website=park.official_website,
-        park_trails=park.alltrails_website,
-        message=message,
-        form=form,
-        samples=photos,
-        cluster_rank=cluster_rank,
-        tags=tags)
+        return json.dumps({
+            'parkunit': parkunit,
+            'cluster_rank': cluster_rank,
+            'photos': [{'url':x['url'], 'title':x['title'], 'ownername':x['ownername']} for x in photos],
+            'tags': tags})
+
+    seed, expires = cache.get_sample_seed(parkunit, cluster_rank)
+    return cached_response(('api_cluster', parkunit, cluster_rank, seed), expires, render, mimetype='application/json')
 
 @app.route('/gallery')
 def gallery():
@@ -156,7 +275,7 @@ def about():
 
 @app.route('/model')
 def model():
-    parks = list(usnp.db.parks.find({}, { "parkname": 1, "_id":0, "parkunit":1, "state":1}).sort("parkname"))
+    parks = usnp.parks.get_all_parks()
     
     for park in parks:
         park['url'] = "img/tiles/" + park['parkunit'] + ".jpg"
@@ -165,16 +284,38 @@ def model():
 @app.route('/modeldetails', methods=['GET', 'POST'])
 def model_details():
     parkunit = request.args.get('parkunit')
-    park = usnp.db.parks.find_one({'parkunit':parkunit})
-    park = usnp.Park(parkunit)
+    park = get_park_or_404(parkunit)
     return render_template("modeldetails.html", park=park)
 
 @app.route('/contact')
 def contact():
     return render_template("contact.html")
 
+@app.route('/_stats', methods=['GET'])
+def stats():
+    '''
+    Returns the usage counters of the database connection pool, of the park cache and of the response cache.
+    '''
+    return jsonify({
+        'mongo_pool': usnp.database.pool_stats(),
+        'park_cache': usnp.park_cache.stats(),
+        'response_cache': usnp.response_cache.stats()})
+
 @app.route('/_autocomplete',methods=['GET'])
 def autocomplete():
-    parks = list(usnp.db.parks.find().distinct('parkname'))
-    sorted(parks)
-    return Response(json.dumps(parks), mimetype='application/json')
\ No newline at end of file
+    '''
+    Returns the park names matching ?q= (top matches, see ParkSearch.search), all park names without query.
+    Results are served from the in-memory index and cached by the browser.
+    '''
+    query = request.args.get('q')
+    if query is None:
+        parks = usnp.park_search.get_names()
+    else:
+        limit = max(1, min(request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int), 50))
+        parks = usnp.park_search.search(query, limit=limit)
+
+    response = Response(json.dumps(parks), mimetype='application/json')
+    response.set_etag(usnp.park_search.get_etag())
+    response.cache_control.public = True
+    response.cache_control.max_age = AUTOCOMPLETE_MAX_AGE
+    return response.make_conditional(request)
\ No newline at end of file
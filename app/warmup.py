@@ -0,0 +1,45 @@
+"""
+Warm-up of the process-wide caches before the app accepts traffic
+"""
+import time
+
+import nationalparks as usnp
+from app import views
+
+def warm_up(parkunits=None, verbose=True):
+    '''
+    Loads the data read by every request: park registry, autocomplete index and, for each park,
+    the cached Park object with its clusters and map (when it was not pre-rendered).
+    Run in the master process of a pre-fork server, the data is shared by the workers (copy-on-write).
+
+    Inputs:
+        parkunits (optional, list) parks to load, the parks with the most photos if None (up to the park cache size)
+        verbose (bool) print a summary
+    Output:
+        dictionary (parks, maps rendered, duration in seconds)
+    '''
+    start = time.time()
+
+    ## park registry and autocomplete index
+    parks = usnp.parks.get_all_parks()
+    usnp.park_search.get_names()
+
+    if parkunits is None:
+        parks = sorted(parks, key=lambda x: x.get('photo_count') or 0, reverse=True)
+        parkunits = [x['parkunit'] for x in parks[:usnp.park_cache.maxsize]]
+
+    ## parks (cluster summaries, maps)
+    manifest = views.load_map_manifest()
+    maps = 0
+    for parkunit in parkunits:
+        park = usnp.park_cache.get(parkunit)
+        park.clusters
+        if parkunit not in manifest or not views.is_map_current(parkunit, manifest[parkunit]):
+            park.get_map_html()
+            maps += 1
+
+    summary = {'parks': len(parkunits), 'maps': maps, 'duration': time.time() - start}
+    if verbose:
+        print('... warmed up {0:,} parks ({1:,} maps rendered) in {2:,.1f} s'.format(
+            summary['parks'], summary['maps'], summary['duration']))
+    return summary
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the explore pages (requests/s and latency percentiles of /explore and /update_cluster)
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    python load_test.py --url http://localhost:8080 --requests 2000 --concurrency 16
+"""
+import os, sys
+sys.path.append('..')
+
+import nationalparks as usnp
+
+import time
+import random
+import argparse
+import urllib.parse
+import urllib.request
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+def get_targets(url, parkunits=None):
+    '''
+    Returns the urls of the explore page and of the scenes of each park (read from the local MongoDB).
+
+    Inputs:
+        url (string) e.g. http://localhost:8080
+        parkunits (optional, list) parks to request, all parks if None
+    Output:
+        dictionary (endpoint: list of urls)
+    '''
+    targets = {'/explore': [], '/update_cluster': []}
+    for parkunit in parkunits or usnp.parks.get_all_parkunits():
+        parkname = usnp.parks.parkunit_to_parkname(parkunit)
+        ranks = [x['rank'] for x in usnp.db.find_clusters(parkunit, fields=['rank'])]
+        if not ranks:
+            continue
+        targets['/explore'].append(url + '/explore?' + urllib.parse.urlencode({'autocomp': parkname}))
+        for rank in ranks:
+            targets['/update_cluster'].append(
+                url + '/update_cluster?' + urllib.parse.urlencode({'locationSelect': parkname + '//' + str(rank)}))
+    return targets
+
+def fetch(target):
+    '''
+    Requests a url and returns (latency in seconds, success).
+    '''
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(target, timeout=30) as response:
+            response.read()
+            success = response.status == 200
+    except Exception:
+        success = False
+    return time.perf_counter() - start, success
+
+def run(targets, requests=1000, concurrency=16, seed=0):
+    '''
+    Sends random requests to the targets of an endpoint from concurrent clients.
+
+    Output:
+        dictionary (requests, errors, requests/s, p50 and p99 latencies in ms)
+    '''
+    rng = random.Random(seed)
+    sample = [rng.choice(targets) for _ in range(requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, sample))
+    duration = time.perf_counter() - start
+
+    latencies = np.array([x[0] for x in results]) * 1000
+    return {
+        'requests': requests,
+        'errors': sum(1 for x in results if not x[1]),
+        'rps': requests / duration,
+        'p50': np.percentile(latencies, 50),
+        'p99': np.percentile(latencies, 99)
+        }
+
+def load_test(url, requests=1000, concurrency=16, parkunits=None, warmup=100):
+    '''
+    Prints the throughput and latencies of each endpoint.
+    A first round of requests (warmup) fills the response caches of the workers and is not reported.
+    '''
+    targets = get_targets(url.rstrip('/'), parkunits)
+    results = {}
+    for endpoint, urls in targets.items():
+        if not urls:
+            continue
+        if warmup:
+            run(urls, warmup, concurrency, seed=1)
+        results[endpoint] = run(urls, requests, concurrency)
+        print('... {0:<16} {1:,} requests ({2:,} errors), {3:,.0f} req/s, p50 {4:,.1f} ms, p99 {5:,.1f} ms'.format(
+            endpoint, results[endpoint]['requests'], results[endpoint]['errors'], results[endpoint]['rps'],
+            results[endpoint]['p50'], results[endpoint]['p99']))
+    return results
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-u", "--url", default="http://localhost:8080", help="url of the app")
+    ap.add_argument("-n", "--requests", type=int, default=1000, help="requests per endpoint")
+    ap.add_argument("-c", "--concurrency", type=int, default=16, help="concurrent clients")
+    ap.add_argument("-w", "--warmup", type=int, default=100, help="unreported requests per endpoint")
+    ap.add_argument("parkunits", nargs="*", help="parks to request (all parks by default)")
+    args = ap.parse_args()
+
+    load_test(args.url, args.requests, args.concurrency, args.parkunits or None, args.warmup)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of Park construction latency
+"""
+import os, sys
+sys.path.append('..')
+
+import nationalparks as usnp
+
+import timeit
+
+def eager_park(parkunit):
+    '''
+    Builds a park and loads every attribute (behaviour of the former eager constructor).
+    '''
+    park = usnp.Park(parkunit)
+    park.boundaries
+    park.bbox_points
+    park.polygons
+    park.clusters
+    park.dbscan
+    park.idf
+    return park
+
+def lazy_park(parkunit):
+    '''
+    Builds a park without loading any lazy attribute.
+    '''
+    return usnp.Park(parkunit)
+
+def benchmark(parkunits=('yose', 'grca'), repeat=5):
+    '''
+    Prints the best construction time (in ms) for each park, eager vs lazy.
+    '''
+    for parkunit in parkunits:
+        eager = min(timeit.repeat(lambda: eager_park(parkunit), number=1, repeat=repeat))
+        lazy = min(timeit.repeat(lambda: lazy_park(parkunit), number=1, repeat=repeat))
+        print('... {0}: eager {1:,.1f} ms, lazy {2:,.1f} ms ({3:,.0f}x)'.format(
+            parkunit, eager * 1000, lazy * 1000, eager / lazy))
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:] or ('yose', 'grca'))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Memory footprint of the photos of the largest parks (DataFrame of documents vs columnar photo store)
+"""
+import os, sys
+sys.path.append('..')
+
+import nationalparks as usnp
+from nationalparks import photos
+
+def get_largest_parks(count=5):
+    '''
+    Returns the park units with the most photos.
+    '''
+    parks = usnp.db.parks.find({}, {'_id':0, 'parkunit':1, 'photo_count':1})
+    parks = sorted(parks, key=lambda x: x.get('photo_count') or 0, reverse=True)
+    return [x['parkunit'] for x in parks[:count]]
+
+def report(parkunits=None, count=5):
+    '''
+    Prints the memory used by the photos of each park:
+        documents: DataFrame of the full Mongo documents (Park.get_photos)
+        store: columnar store of the fields used by clustering, tf-idf and plotting (Park.get_photo_store)
+
+    Output:
+        list of dictionaries (parkunit, photos, documents and store sizes in bytes)
+    '''
+    results = []
+    for parkunit in parkunits or get_largest_parks(count):
+        park = usnp.Park(parkunit)
+        documents = park.get_photos().memory_usage(deep=True).sum()
+        store = park.get_photo_store()
+        usage = store.memory_usage()
+        results.append({'parkunit':parkunit, 'photos':len(store), 'documents':documents, 'store':sum(usage.values())})
+
+        print('... {0} ({1:,} photos): documents {2:,.1f} MB, store {3:,.1f} MB ({4:,.1f}x)'.format(
+            parkunit, len(store), documents / 1e6, sum(usage.values()) / 1e6, documents / float(sum(usage.values()))))
+        print('   ... ' + ', '.join('{0} {1:,.0f} kB'.format(x, y / 1e3) for x, y in usage.items()))
+    return results
+
+if __name__ == "__main__":
+    report(sys.argv[1:] or None)
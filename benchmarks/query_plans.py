@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the queries of the app are served by an index (explain plans)
+"""
+import os, sys
+sys.path.append('..')
+
+import nationalparks as usnp
+from nationalparks import database
+
+def get_stages(plan):
+    '''
+    Returns the list of stages of a winning plan (e.g. ['LIMIT', 'FETCH', 'IXSCAN']).
+    '''
+    stages = [plan['stage']]
+    if 'inputStage' in plan:
+        stages += get_stages(plan['inputStage'])
+    for stage in plan.get('inputStages', []):
+        stages += get_stages(stage)
+    return stages
+
+def get_queries(parkunit, parkname):
+    '''
+    Returns the cursors of the main queries of the app for a park.
+    '''
+    cluster_id = usnp.db.clusters.find_one({'parkunit':parkunit, 'rank':1})['labels']
+    return {
+        'parks by parkunit': usnp.db.parks.find({'parkunit':parkunit}).limit(1),
+        'parks by parkname': usnp.db.parks.find({'parkname':parkname}, {'_id':0, 'parkunit':1}).limit(1),
+        'top photos': usnp.db.find_photos(
+            parkunit, labels=cluster_id, fields=database.PHOTO_DISPLAY_FIELDS, recent=True, limit=500),
+        'cluster photos': usnp.db.find_photos(parkunit, labels=cluster_id, fields=database.PHOTO_TAG_FIELDS),
+        'park photos': usnp.db.find_photos(parkunit, fields=database.PHOTO_TAG_FIELDS),
+        'core photos': usnp.db.find_photos(parkunit, core=True, fields=database.PHOTO_GEO_FIELDS),
+        'clusters': usnp.db.find_clusters(parkunit),
+        'top photo pool': usnp.db.top_photos.find({'parkunit':parkunit, 'labels':int(cluster_id)}, {'_id':0, 'photos':1}).limit(1),
+        'dbscan': usnp.db.dbscan.find({'parkunit':parkunit}),
+        'tags': usnp.db.tags.find({'parkunit':parkunit}, {'_id':0})
+        }
+
+def check_query_plans(parkunit='yose'):
+    '''
+    Prints the winning plan of each query.
+
+    Output:
+        True when no query scans a whole collection (COLLSCAN) or sorts in memory (SORT)
+    '''
+    usnp.db.ensure_indexes()
+    parkname = usnp.db.find_park(parkunit)['parkname']
+
+    valid = True
+    for name, cursor in get_queries(parkunit, parkname).items():
+        stages = get_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        ok = 'COLLSCAN' not in stages and 'SORT' not in stages
+        valid = valid and ok
+        print('... {0:<20} {1:<4} {2}'.format(name, 'ok' if ok else 'FAIL', ' > '.join(stages)))
+    return valid
+
+if __name__ == "__main__":
+    if not check_query_plans(*sys.argv[1:]):
+        sys.exit(1)
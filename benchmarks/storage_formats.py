@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the pipeline storage formats (disk size and load time, csv vs parquet)
+"""
+import os, sys
+sys.path.append('..')
+
+from nationalparks import storage
+
+import shutil
+import tempfile
+import timeit
+
+## pipeline stages stored in scrapper/data
+DATA_PATH = '../scrapper/data'
+STAGES = ['image_ids', 'filtered', 'photo_clusters', 'clusters', 'tfidf']
+
+## columns loaded by train_DBSCAN
+POSITION_COLUMNS = ['id', 'latitude', 'longitude']
+
+def get_size(folder, names, fmt):
+    '''
+    Returns the size (bytes) of the datasets of a folder stored in a format.
+    '''
+    return sum(os.path.getsize(storage.get_path(folder, x, fmt)) for x in names)
+
+def load_all(folder, names, columns=None):
+    '''
+    Loads every dataset of a folder.
+    '''
+    for name in names:
+        storage.read_dataset(folder, name, columns=columns)
+
+def benchmark(stages=STAGES, repeat=3):
+    '''
+    Converts the csv datasets of each stage to parquet (temporary folder) and prints the disk size
+    and the best load time of both formats, all columns and positions only (id, latitude, longitude).
+    '''
+    if storage.pyarrow is None:
+        print('... pyarrow is not installed')
+        return
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for stage in stages:
+            folder = os.path.join(DATA_PATH, stage)
+            names = [x for x in storage.list_datasets(folder) if os.path.exists(storage.get_path(folder, x, 'csv'))]
+            if not names:
+                continue
+
+            ## convert datasets
+            parquet_folder = os.path.join(tmp, stage)
+            csv_folder = os.path.join(tmp, stage + '_csv')
+            os.mkdir(csv_folder)
+            for name in names:
+                storage.write_dataset(storage.read_dataset(folder, name), parquet_folder, name, fmt='parquet')
+                shutil.copy(storage.get_path(folder, name, 'csv'), csv_folder)
+
+            csv_size = get_size(csv_folder, names, 'csv')
+            parquet_size = get_size(parquet_folder, names, 'parquet')
+            print('... {0} ({1:,} datasets): csv {2:,.1f} MB, parquet {3:,.1f} MB ({4:,.1f}x)'.format(
+                stage, len(names), csv_size / 1e6, parquet_size / 1e6, csv_size / float(parquet_size)))
+
+            ## load times
+            available = storage.read_dataset(parquet_folder, names[0]).columns
+            columns = POSITION_COLUMNS if all(x in available for x in POSITION_COLUMNS) else None
+            for label, cols in [('all columns', None), ('positions', columns)]:
+                if label == 'positions' and cols is None:
+                    continue
+                csv_time = min(timeit.repeat(lambda: load_all(csv_folder, names, cols), number=1, repeat=repeat))
+                parquet_time = min(timeit.repeat(lambda: load_all(parquet_folder, names, cols), number=1, repeat=repeat))
+                print('   ... {0:<12} csv {1:,.0f} ms, parquet {2:,.0f} ms ({3:,.1f}x)'.format(
+                    label, csv_time * 1000, parquet_time * 1000, csv_time / parquet_time))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:] or STAGES)
@@ -0,0 +1,32 @@
+"""
+Gunicorn settings of the production server:
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is loaded and warmed up once in the master process (preload_app), then forked:
+workers share the read-only data (park registry, parks, clusters, maps) copy-on-write.
+"""
+import os
+import gc
+import multiprocessing
+
+bind = os.environ.get('NATIONALPARKS_BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('NATIONALPARKS_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('NATIONALPARKS_THREADS', 4))
+timeout = int(os.environ.get('NATIONALPARKS_TIMEOUT', 60))
+preload_app = True
+
+## restart workers periodically (bounded memory growth of the unshared pages)
+max_requests = int(os.environ.get('NATIONALPARKS_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+
+def pre_fork(server, worker):
+    ## objects loaded by the master are moved out of the collected generations,
+    ## so the garbage collector of the workers does not write to their (shared) pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    ## MongoDB clients are not fork-safe: each worker opens its own connection pool
+    import nationalparks as usnp
+    usnp.db.reconnect()
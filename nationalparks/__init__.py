@@ -4,6 +4,15 @@ import nationalparks.database as db
 import nationalparks.logger as logger
 from nationalparks.parks import Park
 from nationalparks.parks import Parks
+from nationalparks.cache import ParkCache
+from nationalparks.cache import DataGeneration
+from nationalparks.cache import ResponseCache
+from nationalparks.cache import get_backend
+from nationalparks.search import ParkSearch
 
 db = db.DB()
-parks = Parks()
\ No newline at end of file
+data_generation = DataGeneration()
+parks = Parks()
+park_cache = ParkCache()
+park_search = ParkSearch()
+response_cache = ResponseCache(backend=get_backend())
\ No newline at end of file
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide caches (Park objects, HTTP responses)
+"""
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+import nationalparks as usnp
+
+## number of seconds a process relies on the last data generation read from MongoDB (see DataGeneration)
+GENERATION_CHECK_INTERVAL = float(os.environ.get('NATIONALPARKS_GENERATION_CHECK_INTERVAL', 10))
+
+class DataGeneration():
+    """
+    Data generation of the collections (see DB.get_generation), read from MongoDB at most once per interval.
+    The update scripts increment it (see publish_update): caches built for an older generation are rebuilt
+    by every process, including the web workers.
+
+    Constructor:
+        inputs:
+            interval (float) number of seconds a read generation is trusted
+    Methods:
+        get: return the current generation
+        invalidate: read the generation on next use
+    """
+    def __init__(self, interval=GENERATION_CHECK_INTERVAL):
+        self.interval = interval
+        self.__generation = None
+        self.__time = 0.
+        self.__lock = threading.Lock()
+
+    def get(self):
+        now = time.time()
+        with self.__lock:
+            if self.__generation is not None and now - self.__time < self.interval:
+                return self.__generation
+        generation = usnp.db.get_generation()
+        with self.__lock:
+            self.__generation, self.__time = generation, now
+        return generation
+
+    def invalidate(self):
+        with self.__lock:
+            self.__generation = None
+
+def publish_update():
+    '''
+    Records a change of the collections (to be called by the update scripts once their data is swapped in):
+    increments the data generation seen by every process and clears the caches of the current process.
+
+    Output:
+        new generation (int)
+    '''
+    generation = usnp.db.bump_generation()
+    usnp.data_generation.invalidate()
+    usnp.park_cache.invalidate()
+    usnp.parks.invalidate()
+    usnp.response_cache.invalidate()
+    return generation
+
+## number of parks kept in memory per process (parks warmed up by the production server, see app/warmup.py)
+PARK_CACHE_SIZE = int(os.environ.get('NATIONALPARKS_PARK_CACHE_SIZE', 32))
+
+class ParkCache():
+    """
+    Bounded LRU cache of Park objects keyed by parkunit, with time-to-live.
+    Parks built for an older data generation (see DataGeneration) are rebuilt.
+
+    Constructor:
+        inputs:
+            maxsize (int) maximum number of parks kept in memory
+            ttl (float) number of seconds a park stays valid
+    Methods:
+        get: return the cached park (built on miss)
+        invalidate: drop one park or the whole cache
+        stats: return hit/miss counters
+    """
+    def __init__(self, maxsize=PARK_CACHE_SIZE, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__parks = OrderedDict()
+        self.__invalidations = 0
+        self.__lock = threading.Lock()
+
+    def get(self, parkunit):
+        '''
+        Returns the Park object of the selected unit, building it if needed.
+
+        Input:
+            parkunit (string) e.g. acad
+        Output:
+            Park object
+        '''
+        now = time.time()
+        generation = usnp.data_generation.get()
+        with self.__lock:
+            entry = self.__parks.get(parkunit)
+            if entry is not None and now - entry[0] < self.ttl and entry[1] == generation:
+                self.__parks.move_to_end(parkunit)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            invalidations = self.__invalidations
+
+        ## build outside of the lock (database round trips)
+        park = usnp.Park(parkunit)
+
+        with self.__lock:
+            ## the cache was invalidated during the build (the park may predate the update)
+            if self.__invalidations != invalidations:
+                return park
+            self.__parks[parkunit] = (now, generation, park)
+            self.__parks.move_to_end(parkunit)
+            while len(self.__parks) > self.maxsize:
+                self.__parks.popitem(last=False)
+        return park
+
+    def invalidate(self, parkunit=None):
+        '''
+        Removes a park from the cache. Clears the whole cache when no park unit is given.
+        To be called after the database collections are rewritten.
+        '''
+        with self.__lock:
+            self.__invalidations += 1
+            if parkunit is None:
+                self.__parks.clear()
+            else:
+                self.__parks.pop(parkunit, None)
+
+    def stats(self):
+        '''
+        Returns cache counters.
+        '''
+        with self.__lock:
+            return {
+                'size': len(self.__parks),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses
+                }
+
+## photo samples change once per window (seconds), responses are cached until the end of the window
+SAMPLE_WINDOW = int(os.environ.get('NATIONALPARKS_SAMPLE_WINDOW', 3600))
+
+def get_sample_seed(parkunit, cluster_rank, now=None):
+    '''
+    Returns the seed of the photo sample of a scene for the current window and the end of the window.
+    Every process draws the same photos for a scene during a window.
+
+    Inputs:
+        parkunit (string) e.g. acad
+        cluster_rank (int)
+        now (optional, float) timestamp
+    Output:
+        seed (int), expires (float) timestamp
+    '''
+    now = time.time() if now is None else now
+    window = int(now // SAMPLE_WINDOW)
+    seed = int(hashlib.sha1('{0}/{1}/{2}'.format(parkunit, cluster_rank, window).encode('utf-8')).hexdigest()[:8], 16)
+    return seed, (window + 1) * SAMPLE_WINDOW
+
+class FileBackend():
+    """
+    Response cache shared by the worker processes of a host (one file per entry).
+    Exposes the get/set interface of memcached clients.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        filename = os.path.join(self.path, key)
+        try:
+            with open(filename, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, expire=0):
+        filename = os.path.join(self.path, key)
+        tmp = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((time.time() + expire, value), f)
+        os.replace(tmp, filename)
+        return True
+
+def get_backend(url=None):
+    '''
+    Returns the shared backend of the response cache from NATIONALPARKS_RESPONSE_CACHE_URL:
+        file:///var/cache/nationalparks (local files)
+        memcached://localhost:11211 (requires pymemcache)
+    None when not configured (in-process cache only).
+    '''
+    url = url if url is not None else os.environ.get('NATIONALPARKS_RESPONSE_CACHE_URL')
+    if not url:
+        return None
+    if url.startswith('file://'):
+        return FileBackend(url[len('file://'):])
+    if url.startswith('memcached://'):
+        from pymemcache.client.base import Client
+        host, _, port = url[len('memcached://'):].partition(':')
+        return Client((host, int(port or 11211)), connect_timeout=1, timeout=1)
+    raise ValueError('Unsupported response cache: ' + url)
+
+class ResponseCache():
+    """
+    Bounded LRU cache of rendered responses with expiry, optionally backed by a shared backend
+    (see get_backend) so that all the worker processes reuse the same responses.
+
+    Constructor:
+        inputs:
+            maxsize (int) maximum number of responses kept in memory
+            backend (optional) object exposing get(key) and set(key, value, expire) (e.g. memcached client)
+    Methods:
+        get: return a cached response
+        set: store a response until a timestamp
+        invalidate: drop all the responses of the process
+        stats: return hit/miss counters
+    """
+    def __init__(self, maxsize=256, backend=None):
+        self.maxsize = maxsize
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.__responses = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __backend_key(self, key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        Returns the response stored under key (None when missing or expired).
+        '''
+        now = time.time()
+        with self.__lock:
+            entry = self.__responses.get(key)
+            if entry is not None and entry[0] > now:
+                self.__responses.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        ## shared backend (a failure is a miss)
+        if self.backend is not None:
+            try:
+                data = self.backend.get(self.__backend_key(key))
+            except Exception:
+                data = None
+            expires, value = pickle.loads(data) if data is not None else (0, None)
+            if expires > now:
+                self.__store(key, value, expires)
+                with self.__lock:
+                    self.hits += 1
+                return value
+
+        with self.__lock:
+            self.misses += 1
+        return None
+
+    def __store(self, key, value, expires):
+        with self.__lock:
+            self.__responses[key] = (expires, value)
+            self.__responses.move_to_end(key)
+            while len(self.__responses) > self.maxsize:
+                self.__responses.popitem(last=False)
+
+    def set(self, key, value, expires):
+        '''
+        Stores a response until expires (timestamp).
+        '''
+        self.__store(key, value, expires)
+        if self.backend is not None:
+            try:
+                self.backend.set(self.__backend_key(key), pickle.dumps((expires, value)), expire=max(int(expires - time.time()), 1))
+            except Exception:
+                pass
+
+    def invalidate(self):
+        '''
+        Clears the responses of the process. Shared entries of older data are no longer hit: the response
+        keys include the data generation (see DataGeneration).
+        '''
+        with self.__lock:
+            self.__responses.clear()
+
+    def stats(self):
+        '''
+        Returns cache counters.
+        '''
+        with self.__lock:
+            return {
+                'size': len(self.__responses),
+                'maxsize': self.maxsize,
+                'backend': type(self.backend).__name__ if self.backend is not None else None,
+                'hits': self.hits,
+                'misses': self.misses
+                }
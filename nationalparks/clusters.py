@@ -4,9 +4,29 @@ Clusters object
 """
 import pandas as pd
 import nationalparks as usnp
-from sklearn.cluster import DBSCAN
-from sklearn.metrics import silhouette_samples, silhouette_score
+from nationalparks import database
+from sklearn.neighbors import NearestNeighbors
+from sklearn.metrics import silhouette_samples, silhouette_score, davies_bouldin_score, calinski_harabasz_score
+from sklearn.metrics import pairwise_distances_chunked
 import numpy
+import scipy.sparse
+import scipy.sparse.csgraph
+
+## scoring modes of the hyper-parameter tuning
+##   exact: silhouette score of all the photos
+##   sample: silhouette score of a stratified sample of the photos (fixed seed)
+##   chunked: exact silhouette score, distances computed by blocks of rows under an explicit memory cap
+##   davies_bouldin, calinski_harabasz: cheaper cluster validity indexes
+SCORING_MODES = ['exact', 'sample', 'chunked', 'davies_bouldin', 'calinski_harabasz']
+
+## distances used by DBSCAN
+##   degrees: euclidean distance between raw coordinates (eps in degrees)
+##   projected: euclidean distance in a local equirectangular projection of the park (eps in metres)
+##   haversine: great-circle distance, ball tree neighbour search (eps in metres)
+METRICS = ['degrees', 'projected', 'haversine']
+
+## mean earth radius (m)
+EARTH_RADIUS = 6371008.8
 
 class Clusters():
     '''
@@ -16,63 +36,90 @@ class Clusters():
     def __init__(self, parkunit):
         self.park = usnp.Park(parkunit)
 
-    def train_DBSCAN(self, verbose=True):
+    def train_DBSCAN(self, verbose=True, n_jobs=-1, scoring='exact', sample_size=10000, random_state=0, metric='degrees'):
         '''
         Performs DBSCAN clustering of images based on latitude and longitude.
+
+        Inputs:
+            verbose (bool) print park name
+            n_jobs (int) number of parallel jobs used by DBSCAN (-1: all cores)
+            scoring (string) one of SCORING_MODES, used to select eps and min_samples
+            sample_size (int) number of photos scored in sample mode
+            random_state (int) seed of the sample mode
+            metric (string) one of METRICS, distance used by DBSCAN (the unit of eps depends on it)
         '''
+        if scoring not in SCORING_MODES:
+            raise ValueError("scoring must be one of " + ", ".join(SCORING_MODES))
+        if metric not in METRICS:
+            raise ValueError("metric must be one of " + ", ".join(METRICS))
+
         if verbose: print("... " + self.park.parkname + " (" + self.park.parkunit + ")")
-        ## get all photos
-        df_photos = self.park.get_photos()
-        ## sort by latitude and longitude
-        df_photos = df_photos.sort_values(by=['longitude', 'latitude'])
-        ## extract latitude and longitude
-        df_geo = df_photos[['latitude', 'longitude']]
-        ## compute differences
-        diff = df_geo.diff()
-        ## compute euclidian distance
-        diff['distance'] = (diff['latitude']**2 + diff['longitude']**2) ** 0.5
-        ## format dataframe
-        diff = diff.rename(columns={'latitude':"latitude_diff", 'longitude':'longitude_diff'})
-        ## merge data
-        df_geo = pd.concat([df_photos[df_photos.columns.difference(['latitude', 'longitude'])], df_geo, diff], axis=1)
+        ## get the position of all photos (columnar store)
+        store = self.park.get_photo_store(fields=database.PHOTO_POSITION_FIELDS)
+        ## sort by longitude and latitude
+        order = numpy.lexsort((store.latitude, store.longitude))
+        longitudes, latitudes = store.longitude[order], store.latitude[order]
+        ## compute distance between consecutive photos
+        if metric == 'degrees':
+            distance = numpy.concatenate([[numpy.nan], numpy.hypot(numpy.diff(latitudes), numpy.diff(longitudes))])
+        else:
+            distance = self.consecutive_distances(longitudes, latitudes, metric)
+        distance = pd.Series(distance)
+        n_photos = len(order)
 
         ## HYPER-PARAMETER TUNING
         ## eps
         best_score = -1
         best_eps = 0
         ## create a set of candidate values for eps based on quantile distribution of the distance between points
-        range_eps = df_geo[~df_geo['distance'].isnull()]['distance'].quantile([0.2,0.25,0.3,0.35,0.4,0.45,0.5,0.55,0.6,0.65,0.675,0.70,0.75,0.8,0.825,0.85,0.875,0.90,0.925,0.95,0.975,0.98,0.99,0.995])
+        range_eps = distance[~distance.isnull()].quantile([0.2,0.25,0.3,0.35,0.4,0.45,0.5,0.55,0.6,0.65,0.675,0.70,0.75,0.8,0.825,0.85,0.875,0.90,0.925,0.95,0.975,0.98,0.99,0.995])
         
-        if df_geo.shape[0]<=100:
+        if n_photos<=100:
             min_cluster_count = 2
             max_cluster_count = 5
-        elif df_geo.shape[0]<=1000:
+        elif n_photos<=1000:
             min_cluster_count = 5
             max_cluster_count = 50
-        elif df_geo.shape[0]<=10000:
+        elif n_photos<=10000:
             min_cluster_count= 10
             max_cluster_count = 500
         else:
             min_cluster_count = 10
             max_cluster_count = 500        
+
+        ## compute the neighbour graph once (largest candidate eps) and derive every candidate from it,
+        ## the graph is pruned in place from the largest to the smallest eps
+        X = numpy.column_stack([longitudes, latitudes])
+        if metric == 'projected':
+            X = self.project(X[:, 0], X[:, 1])
+        ## silhouette and validity indexes are computed in the plane
+        X_score = X if metric != 'haversine' else self.project(X[:, 0], X[:, 1])
+        graph_metric = 'haversine' if metric == 'haversine' else 'euclidean'
+        candidates = sorted(set([i for i in range_eps if i != 0 and i <= 0.4 * distance.max()]), reverse=True)
+        fits = {}
+        if candidates:
+            graph = NeighborGraph(X, candidates[0], n_jobs=n_jobs, metric=graph_metric)
+            for i in candidates:
+                graph.prune(i)
+                fits[i] = graph.fit_DBSCAN(eps=i, min_samples=5)
+            del graph
         
         for i in range_eps:
             if i==0:
                 continue
-            if i > 0.4 * df_geo['distance'].max():
+            if i > 0.4 * distance.max():
                 continue
             ## create and train DBSCAN
-            db = DBSCAN(eps=i, min_samples=5, n_jobs=-1).fit(df_geo[['latitude', 'longitude']]) 
-            labels = db.labels_
+            labels, core = fits[i]
             ## compute silhouette score
             if len(set(labels))>=min_cluster_count and len(set(labels))<=max_cluster_count:
                 if min_cluster_count==1 and len(set(labels))==1 and best_score==-1:
                     print("   For eps value = "+str(i), "\n   Number of clusters: {}".format(len(set(labels))))
                     best_eps = i
                 else:
-                    silhouette_avg = silhouette_score(df_geo[['longitude', 'latitude']], labels)
+                    silhouette_avg = self.score_clusters(X_score, labels, scoring=scoring, sample_size=sample_size, random_state=random_state)
                     print("   For eps value: "+str(i), ", quantile: {:.5f}".format(i), "\n      Number of clusters: {}".format(len(set(labels))),
-                    "\n      Avg silhouette score is: {:.4f}".format(silhouette_avg))
+                    "\n      Avg {} score is: {:.4f}".format(scoring, silhouette_avg))
                 if best_score < silhouette_avg:
                     print("      => Improved")
                     best_score = silhouette_avg
@@ -84,38 +131,202 @@ class Clusters():
         best_score = -1
         best_min_samples = 0
         min_samples = [2,3,5,6,7,8,9,10,12,14,16,18,20]
+        graph = NeighborGraph(X, best_eps, n_jobs=n_jobs, metric=graph_metric)
         for i in min_samples:
             ## create and train DBSCAN
-            db = DBSCAN(eps=best_eps, min_samples=i, n_jobs=-1).fit(df_geo[['longitude', 'latitude']])
-            labels = db.labels_
+            labels, core = graph.fit_DBSCAN(eps=best_eps, min_samples=i)
             ## compute silhouette score
             if len(set(labels)) >= min_cluster_count:
                 if min_cluster_count==1 and len(set(labels))==1 and best_score==-1 and best_min_samples==0:
                     print("   For eps value = "+str(i), "\n   Number of clusters: {}".format(len(set(labels))))
                     best_min_samples=i
                 else:
-                    silhouette_avg = silhouette_score(df_geo[['longitude', 'latitude']], labels)
+                    silhouette_avg = self.score_clusters(X_score, labels, scoring=scoring, sample_size=sample_size, random_state=random_state)
                     print("   For min_sample value = "+str(i), "\n      Number of clusters: {}".format(len(set(labels))),
-                    "\n      Avg silhouette score is: {:.4f}".format(silhouette_avg))
+                    "\n      Avg {} score is: {:.4f}".format(scoring, silhouette_avg))
                     if best_score < silhouette_avg and len(set(labels))>=min_cluster_count:
                         print("      => Improved")
                         best_score = silhouette_avg
                         best_min_samples = i
         
         ## train final DBSCAN
-        db = DBSCAN(eps=best_eps, min_samples=best_min_samples, n_jobs=-1).fit(df_geo[['longitude', 'latitude']])
+        labels, core = graph.fit_DBSCAN(eps=best_eps, min_samples=best_min_samples)
 
         ## get core samples
-        core_sample_mask = numpy.zeros_like(db.labels_, dtype=bool)
-        core_sample_mask[db.core_sample_indices_] = True
-        df_geo['core'] = core_sample_mask
-        df_geo['labels'] = db.labels_
+        df_geo = pd.DataFrame(
+            {'latitude':latitudes, 'longitude':longitudes, 'core':core, 'labels':labels},
+            index=pd.Index(store.id[order], name='id'))
+
+        return df_geo, labels.max() + 1, best_eps, best_min_samples
+
+    def project(self, longitudes, latitudes):
+        '''
+        Projects coordinates in a local equirectangular projection centred on the photos (metres).
+        Distances are preserved for the extent of a park.
+
+        Inputs:
+            longitudes (array) degrees
+            latitudes (array) degrees
+        Output:
+            array of (x, y) coordinates in metres
+        '''
+        longitudes = numpy.radians(numpy.asarray(longitudes, dtype=float))
+        latitudes = numpy.radians(numpy.asarray(latitudes, dtype=float))
+        lon_0 = (longitudes.min() + longitudes.max()) / 2.
+        lat_0 = (latitudes.min() + latitudes.max()) / 2.
+        x = EARTH_RADIUS * (longitudes - lon_0) * numpy.cos(lat_0)
+        y = EARTH_RADIUS * (latitudes - lat_0)
+        return numpy.column_stack([x, y])
+
+    def consecutive_distances(self, longitudes, latitudes, metric):
+        '''
+        Returns the distance (metres) between consecutive photos, the first value is NaN.
+
+        Inputs:
+            longitudes (array) degrees
+            latitudes (array) degrees
+            metric (string) projected or haversine
+        '''
+        if metric == 'projected':
+            xy = self.project(longitudes, latitudes)
+            distances = numpy.hypot(numpy.diff(xy[:, 0]), numpy.diff(xy[:, 1]))
+        else:
+            lon = numpy.radians(numpy.asarray(longitudes, dtype=float))
+            lat = numpy.radians(numpy.asarray(latitudes, dtype=float))
+            a = numpy.sin(numpy.diff(lat) / 2.)**2 + numpy.cos(lat[:-1]) * numpy.cos(lat[1:]) * numpy.sin(numpy.diff(lon) / 2.)**2
+            distances = 2. * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(a))
+        return numpy.concatenate([[numpy.nan], distances])
+
+    def score_clusters(self, X, labels, scoring='exact', sample_size=10000, random_state=0, working_memory=256):
+        '''
+        Scores a clustering, the higher the better.
+        Cluster validity indexes are mapped to [0, 1) (monotonic) so that they compare with silhouette scores.
 
-        del df_geo['distance']
-        del df_geo['latitude_diff']
-        del df_geo['longitude_diff']
+        Inputs:
+            X (array) coordinates
+            labels (array) cluster id of each point
+            scoring (string) one of SCORING_MODES
+            sample_size (int) number of points scored in sample mode
+            random_state (int) seed of the sample mode
+            working_memory (int) memory (MB) used by a chunk of pairwise distances in chunked mode
+        Output:
+            score (float)
+        '''
+        if scoring == 'exact':
+            return silhouette_score(X, labels)
+        elif scoring == 'sample':
+            sample = self.sample_stratified(labels, sample_size, random_state)
+            return silhouette_score(X[sample], labels[sample])
+        elif scoring == 'chunked':
+            return self.silhouette_chunked(X, labels, working_memory)
+        elif scoring == 'davies_bouldin':
+            return 1. / (1. + davies_bouldin_score(X, labels))
+        elif scoring == 'calinski_harabasz':
+            score = calinski_harabasz_score(X, labels)
+            return score / (1. + score)
+        raise ValueError("scoring must be one of " + ", ".join(SCORING_MODES))
+
+    def silhouette_chunked(self, X, labels, working_memory=256):
+        '''
+        Returns the silhouette score of all the points. The distances of a block of rows to all the points
+        are reduced to per-cluster sums before the next block is computed: the memory used is bounded by
+        working_memory (distance block) plus rows x clusters sums, whatever the number of points.
 
-        return df_geo, db.labels_.max() + 1, best_eps, best_min_samples
+        Inputs:
+            X (array) coordinates
+            labels (array) cluster id of each point
+            working_memory (int) memory (MB) of a block of pairwise distances
+        Output:
+            score (float)
+        '''
+        _, codes = numpy.unique(labels, return_inverse=True)
+        counts = numpy.bincount(codes)
+        n_points, n_clusters = codes.shape[0], counts.shape[0]
+        membership = scipy.sparse.csr_matrix(
+            (numpy.ones(n_points), (numpy.arange(n_points), codes)), shape=(n_points, n_clusters))
+
+        def reduce_func(D, start):
+            ## sum of the distances of each row to the points of each cluster
+            sums = numpy.asarray(membership.T.dot(D.T).T)
+            rows = numpy.arange(D.shape[0])
+            own = codes[start:start + D.shape[0]]
+
+            ## mean distance to the own cluster (a) and to the nearest other cluster (b)
+            a = sums[rows, own] / numpy.maximum(counts[own] - 1, 1)
+            means = sums / counts
+            means[rows, own] = numpy.inf
+            b = means.min(axis=1)
+
+            ## points alone in their cluster score 0
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                scores = (b - a) / numpy.maximum(a, b)
+            scores[counts[own] == 1] = 0.
+            return numpy.nan_to_num(scores)
+
+        chunks = pairwise_distances_chunked(X, reduce_func=reduce_func, working_memory=working_memory)
+        return float(numpy.concatenate(list(chunks)).mean())
+
+    def sample_stratified(self, labels, sample_size, random_state=0):
+        '''
+        Returns the indices of a sample of the points, stratified by cluster (every cluster is represented).
+
+        Inputs:
+            labels (array) cluster id of each point
+            sample_size (int) approximate number of sampled points
+            random_state (int) seed
+        Output:
+            sorted array of indices
+        '''
+        labels = numpy.asarray(labels)
+        if len(labels) <= sample_size:
+            return numpy.arange(len(labels))
+        random = numpy.random.RandomState(random_state)
+        sample = []
+        for label in numpy.unique(labels):
+            members = numpy.flatnonzero(labels == label)
+            count = max(1, int(round(sample_size * len(members) / float(len(labels)))))
+            sample.append(random.choice(members, count, replace=False))
+        return numpy.sort(numpy.concatenate(sample))
+
+    def assign_photos(self, longitudes, latitudes):
+        '''
+        Assigns new photos to the existing clusters of the park, using the stored DBSCAN parameters.
+        A photo joins the cluster of its nearest core photo if it lies within eps, otherwise it is noise (-1).
+
+        Inputs:
+            longitudes (array) degrees
+            latitudes (array) degrees
+        Output:
+            array of cluster ids
+        '''
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        labels = numpy.full(len(longitudes), -1, dtype=numpy.int64)
+
+        ## stored parameters (eps in metres for the projected and haversine metrics)
+        eps = float(self.park.dbscan['eps'][0])
+        metric = self.park.dbscan.get('metric', {0: 'degrees'})[0]
+        if not isinstance(metric, str):
+            metric = 'degrees'
+
+        ## core photos of the clustering
+        core = self.park.get_photo_store(fields=database.PHOTO_GEO_FIELDS, core=True)
+        if len(core) == 0 or len(longitudes) == 0:
+            return labels
+
+        if metric == 'degrees':
+            neighbors = NearestNeighbors(n_neighbors=1).fit(numpy.column_stack([core.longitude, core.latitude]))
+            distances, indices = neighbors.kneighbors(numpy.column_stack([longitudes, latitudes]))
+        else:
+            ## great-circle distance (the local projection of the training matches it at the scale of a park)
+            neighbors = NearestNeighbors(n_neighbors=1, metric='haversine', algorithm='ball_tree').fit(
+                numpy.radians(numpy.column_stack([core.latitude, core.longitude])))
+            distances, indices = neighbors.kneighbors(numpy.radians(numpy.column_stack([latitudes, longitudes])))
+            distances = distances * EARTH_RADIUS
+
+        within = distances[:, 0] <= eps
+        labels[within] = core.labels[indices[within, 0]]
+        return labels
 
     def jaccard_index(tags_cluster_1, tags_cluster_2):
         '''
@@ -147,3 +358,106 @@ class Clusters():
         df = df.set_index('id', drop=True)
         return df
 
+class NeighborGraph():
+    '''
+    Radius-neighbour graph of a set of coordinates, shared by every DBSCAN fit of a hyper-parameter sweep.
+    Duplicated coordinates are collapsed into a single point weighted by its number of photos.
+    Constructor:
+        inputs:
+            X (array) coordinates, (longitude, latitude) in degrees for the haversine metric
+            radius (float) largest distance stored in the graph (metres for the haversine metric)
+            n_jobs (int) number of parallel jobs of the neighbour search
+            metric (string) euclidean or haversine
+    Methods:
+        prune: remove the edges longer than a smaller radius
+        fit_DBSCAN: return DBSCAN labels and core mask for a given eps and min_samples
+    '''
+    def __init__(self, X, radius, n_jobs=-1, metric='euclidean'):
+        self.points, inverse, self.weights = numpy.unique(numpy.asarray(X, dtype=float), axis=0, return_inverse=True, return_counts=True)
+        self.inverse = inverse.ravel()
+        self.radius = radius
+        self.metric = metric
+        if metric == 'haversine':
+            ## ball tree on (latitude, longitude) in radians, distances converted to metres
+            points = numpy.radians(self.points[:, ::-1])
+            neighbors = NearestNeighbors(radius=radius / EARTH_RADIUS, metric='haversine', algorithm='ball_tree', n_jobs=n_jobs).fit(points)
+            self.graph = neighbors.radius_neighbors_graph(points, mode='distance')
+            self.graph.data *= EARTH_RADIUS
+        else:
+            neighbors = NearestNeighbors(radius=radius, n_jobs=n_jobs).fit(self.points)
+            self.graph = neighbors.radius_neighbors_graph(self.points, mode='distance')
+        ## each point is its own neighbour (distance 0)
+
+    def prune(self, radius):
+        '''
+        Removes the edges of the graph that are longer than radius.
+        '''
+        keep = self.graph.data <= radius
+        if not keep.all():
+            self.graph = self.__filter_edges(self.graph, keep)
+        self.radius = min(self.radius, radius)
+
+    def __filter_edges(self, graph, keep):
+        '''
+        Returns the graph restricted to the selected edges (boolean mask over the stored entries).
+        '''
+        indptr = numpy.zeros_like(graph.indptr)
+        if graph.nnz:
+            numpy.cumsum(numpy.add.reduceat(keep, graph.indptr[:-1]), out=indptr[1:])
+        return scipy.sparse.csr_matrix((graph.data[keep], graph.indices[keep], indptr), shape=graph.shape)
+
+    def fit_DBSCAN(self, eps, min_samples):
+        '''
+        DBSCAN clustering derived from the graph (only edges shorter than eps are used).
+        Returns the same labels as sklearn.cluster.DBSCAN: clusters are numbered by their first core point
+        and a border point joins the cluster with the lowest label amongst its core neighbours.
+
+        Inputs:
+            eps (float) maximum distance between two neighbours (<= radius of the graph)
+            min_samples (int) number of neighbours (self included) of a core point
+        Outputs:
+            labels (array) cluster id of each photo (-1 for noise)
+            core (array) boolean mask of the core photos
+        '''
+        if not eps > 0:
+            raise ValueError("eps must be positive.")
+        if eps > self.radius:
+            raise ValueError("eps must be lower than the radius of the graph.")
+        graph = self.graph
+        keep = graph.data <= eps
+        if not keep.all():
+            graph = self.__filter_edges(graph, keep)
+
+        ## core points (photo count within eps, duplicates included)
+        core = numpy.add.reduceat(self.weights[graph.indices], graph.indptr[:-1]) >= min_samples
+        labels = numpy.full(len(self.points), -1, dtype=numpy.int64)
+        if core.any():
+
+            ## clusters = connected components of the core points
+            ## (the graph is symmetric, strong components are the undirected components)
+            core_edges = numpy.repeat(core, numpy.diff(graph.indptr)) & core[graph.indices]
+            _, components = scipy.sparse.csgraph.connected_components(
+                self.__filter_edges(graph, core_edges), directed=True, connection='strong')
+            del core_edges
+
+            ## number clusters by their first core photo
+            core_photos = numpy.flatnonzero(core[self.inverse])
+            photo_components = components[self.inverse[core_photos]]
+            _, first = numpy.unique(photo_components, return_index=True)
+            order = photo_components[numpy.sort(first)]
+            rank = numpy.empty(components.max() + 1, dtype=numpy.int64)
+            rank[order] = numpy.arange(len(order))
+            labels[core] = rank[components[core]]
+
+            ## border points join the core neighbour cluster with the lowest label
+            no_label = numpy.iinfo(numpy.int64).max
+            border = numpy.flatnonzero(~core)
+            border_graph = graph[border]
+            if border_graph.nnz:
+                neighbor_labels = labels[border_graph.indices]
+                neighbor_labels[neighbor_labels == -1] = no_label
+                border_labels = numpy.minimum.reduceat(neighbor_labels, border_graph.indptr[:-1])
+                assigned = border_labels != no_label
+                labels[border[assigned]] = border_labels[assigned]
+
+        return labels[self.inverse], core[self.inverse]
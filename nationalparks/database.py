@@ -2,29 +2,359 @@
 Create connections to database
 """
 
+import os
+import threading
+import pandas as pd
+import pymongo
+import pymongo.monitoring
 from pymongo import MongoClient
-from nationalparks import secrets as sec
 
-class DB:
+## credentials of the hosted cluster (not needed when NATIONALPARKS_MONGO_URI is set)
+try:
+    from nationalparks import secrets as sec
+except ImportError:
+    sec = None
+
+## indexes of each collection (see DB.ensure_indexes)
+INDEXES = {
+    'parks': [
+        [('parkunit', pymongo.ASCENDING)],
+        [('parkname', pymongo.ASCENDING)]
+        ],
+    'photos': [
+        [('parkunit', pymongo.ASCENDING), ('labels', pymongo.ASCENDING), ('dateupload', pymongo.DESCENDING)],
+        [('parkunit', pymongo.ASCENDING), ('core', pymongo.ASCENDING)]
+        ],
+    'clusters': [
+        [('parkunit', pymongo.ASCENDING), ('rank', pymongo.ASCENDING)]
+        ],
+    'dbscan': [
+        [('parkunit', pymongo.ASCENDING)]
+        ],
+    'tags': [
+        [('parkunit', pymongo.ASCENDING), ('labels', pymongo.ASCENDING)]
+        ],
+    'top_photos': [
+        [('parkunit', pymongo.ASCENDING), ('labels', pymongo.ASCENDING)]
+        ]
+    }
+
+## photo fields used by each caller
+PHOTO_DISPLAY_FIELDS = ['id', 'farm', 'server', 'secret', 'title', 'ownername', 'dateupload']
+PHOTO_TAG_FIELDS = ['id', 'labels', 'tags']
+PHOTO_GEO_FIELDS = ['longitude', 'latitude', 'labels']
+PHOTO_POSITION_FIELDS = ['id', 'latitude', 'longitude']
+
+def projection(fields):
     '''
-    Database class
+    Converts a list of fields into a MongoDB projection (None returns the full documents).
+    '''
+    if fields is None:
+        return None
+    return dict({'_id':0}, **{x:1 for x in fields})
+
+## client settings read from the environment (name: (variable, default, type))
+CLIENT_SETTINGS = {
+    'maxPoolSize': ('NATIONALPARKS_MONGO_MAX_POOL_SIZE', 50, int),
+    'minPoolSize': ('NATIONALPARKS_MONGO_MIN_POOL_SIZE', 0, int),
+    'maxIdleTimeMS': ('NATIONALPARKS_MONGO_MAX_IDLE_TIME_MS', 300000, int),
+    'waitQueueTimeoutMS': ('NATIONALPARKS_MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000, int),
+    'serverSelectionTimeoutMS': ('NATIONALPARKS_MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000, int),
+    'connectTimeoutMS': ('NATIONALPARKS_MONGO_CONNECT_TIMEOUT_MS', 5000, int),
+    'socketTimeoutMS': ('NATIONALPARKS_MONGO_SOCKET_TIMEOUT_MS', 30000, int),
+    'readPreference': ('NATIONALPARKS_MONGO_READ_PREFERENCE', 'primaryPreferred', str),
+    'compressors': ('NATIONALPARKS_MONGO_COMPRESSORS', 'zlib', str)
+    }
+
+class PoolMonitor(pymongo.monitoring.ConnectionPoolListener):
+    '''
+    Connection pool listener counting the connections of the shared client.
+    Methods:
+        stats: return pool counters
     '''
     def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {
+            'pools': 0, 'created': 0, 'closed': 0, 'checked_out': 0,
+            'checkouts': 0, 'checkout_failures': 0, 'max_checked_out': 0, 'cleared': 0
+            }
+
+    def __update(self, **increments):
+        with self.__lock:
+            for key, value in increments.items():
+                self.__counters[key] += value
+            self.__counters['max_checked_out'] = max(self.__counters['max_checked_out'], self.__counters['checked_out'])
+
+    def pool_created(self, event):
+        self.__update(pools=1)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.__update(cleared=1)
+
+    def pool_closed(self, event):
+        self.__update(pools=-1)
+
+    def connection_created(self, event):
+        self.__update(created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.__update(closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.__update(checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self.__update(checked_out=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self.__update(checked_out=-1)
+
+    def stats(self):
+        '''
+        Returns the pool counters (open = created - closed, checked_out = connections in use).
+        '''
+        with self.__lock:
+            stats = dict(self.__counters)
+        stats['open'] = stats['created'] - stats['closed']
+        return stats
+
+## shared client (one per process)
+pool_monitor = PoolMonitor()
+_client = {'client': None, 'pid': None}
+_client_lock = threading.Lock()
+
+def get_uri():
+    '''
+    Returns the connection string: NATIONALPARKS_MONGO_URI (e.g. mongodb://localhost:27017 for a local mongod),
+    the hosted cluster otherwise (ValueError when its credentials are missing).
+    '''
+    uri = os.environ.get('NATIONALPARKS_MONGO_URI')
+    if uri:
+        return uri
+    if sec is None:
+        raise ValueError('MongoDB credentials not found: set NATIONALPARKS_MONGO_URI or create nationalparks/secrets.py')
+    return "mongodb+srv://%s:%s@%s.mongodb.net/test?retryWrites=true&w=majority" % (sec.mongouser, sec.mongopwd, sec.mongohost)
+
+def get_client_settings():
+    '''
+    Returns the keyword arguments of the client (CLIENT_SETTINGS overridden by the environment).
+    '''
+    settings = {}
+    for name, (variable, default, cast) in CLIENT_SETTINGS.items():
+        value = os.environ.get(variable)
+        settings[name] = default if value is None else cast(value)
+    if not settings['compressors']:
+        del settings['compressors']
+    return settings
+
+def get_client():
+    '''
+    Returns the MongoClient shared by the app and the pipeline.
+    The client is created on first use and re-created in forked or spawned worker processes.
+    '''
+    with _client_lock:
+        if _client['client'] is None or _client['pid'] != os.getpid():
+            _client['client'] = MongoClient(
+                get_uri(),
+                connect=False,
+                event_listeners=[pool_monitor],
+                **get_client_settings())
+            _client['pid'] = os.getpid()
+        return _client['client']
+
+def pool_stats():
+    '''
+    Returns the usage counters of the connection pool of the shared client.
+    '''
+    stats = pool_monitor.stats()
+    stats['max_pool_size'] = get_client_settings()['maxPoolSize']
+    return stats
+
+class DB:
+    '''
+    Database class (collections of the shared client)
+    '''
+    def __init__(self, client=None):
         '''
         Creates database engine
+
+        Input:
+            client (optional) MongoClient, the shared client if None
+        '''
+        self.__bind(client if client is not None else get_client())
+
+    def __bind(self, client):
+        '''
+        Binds the database and its collections to a client.
         '''
-        self.client = MongoClient(
-            "mongodb+srv://%s:%s@%s.mongodb.net/test?retryWrites=true&w=majority" % (sec.mongouser,
-                                                                                     sec.mongopwd,
-                                                                                     sec.mongohost),
-            connect=False)
-        
+        self.client = client
+
         ## database
-        self.db = self.client.NationalParks
+        self.db = self.client[os.environ.get('NATIONALPARKS_MONGO_DB', 'NationalParks')]
 
         ## collections
         self.parks = self.db.parks
         self.photos = self.db.photos
 
         self.dbscan = self.db.dbscan
-        self.clusters = self.db.clusters
\ No newline at end of file
+        self.clusters = self.db.clusters
+        self.tags = self.db.tags
+        self.top_photos = self.db.top_photos
+
+        ## pipeline state shared by every process (data generation)
+        self.meta = self.db.meta
+
+    def reconnect(self):
+        '''
+        Binds the collections to the shared client of the current process.
+        To be called in worker processes forked after the database was used (e.g. gunicorn --preload).
+        '''
+        self.__bind(get_client())
+
+    def ensure_indexes(self):
+        '''
+        Creates the indexes of every collection (no-op when they already exist).
+
+        Output:
+            list of index names
+        '''
+        names = []
+        for collection, indexes in INDEXES.items():
+            for keys in indexes:
+                names.append(self.db[collection].create_index(keys, background=True))
+        return names
+
+    def bulk_load(self, collection, chunks, batch_size=1000):
+        '''
+        Replaces the content of a collection without exposing an empty or partial collection.
+        Documents are inserted in a staging collection (unordered batches), indexed, then the staging
+        collection is renamed over the target (atomic swap).
+
+        Inputs:
+            collection (string) e.g. photos
+            chunks (iterable) dataframes or lists of documents to insert (e.g. storage.read_chunks)
+            batch_size (int) number of documents per insert
+        Output:
+            number of documents loaded
+        '''
+        staging = self.db[collection + '_staging']
+        staging.drop()
+
+        count = 0
+        try:
+            for chunk in chunks:
+                records = chunk.to_dict(orient='records') if isinstance(chunk, pd.DataFrame) else list(chunk)
+                for i in range(0, len(records), batch_size):
+                    staging.insert_many(records[i:i + batch_size], ordered=False)
+                count += len(records)
+        except Exception:
+            ## the target collection is left untouched
+            staging.drop()
+            raise
+
+        ## indexes are built before the swap
+        for keys in INDEXES.get(collection, []):
+            staging.create_index(keys)
+
+        if count == 0:
+            staging.drop()
+            self.db[collection].delete_many({})
+        else:
+            staging.rename(collection, dropTarget=True)
+        return count
+
+    def get_generation(self):
+        '''
+        Returns the data generation, incremented by the update scripts after each change of the collections.
+        '''
+        result = self.meta.find_one({'_id':'data'}, {'generation':1})
+        return int(result['generation']) if result else 0
+
+    def bump_generation(self):
+        '''
+        Increments the data generation (see get_generation), returns the new value.
+        '''
+        result = self.meta.find_one_and_update(
+            {'_id':'data'}, {'$inc': {'generation':1}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        return int(result['generation'])
+
+    def find_park(self, parkunit):
+        '''
+        Returns the document of a park (None if the park does not exist).
+        '''
+        return self.parks.find_one({'parkunit':parkunit})
+
+    def find_parkunit(self, parkname):
+        '''
+        Returns the park unit of a park name (None if the park does not exist).
+
+        Input:
+            parkname (string) e.g. Acadia National Park
+        Output:
+            parkunit (string) e.g. acad
+        '''
+        result = self.parks.find_one({'parkname':parkname}, {'_id':0, 'parkunit':1})
+        if result:
+            return result['parkunit']
+        return None
+
+    def find_photos(self, parkunit, labels=None, core=None, fields=None, recent=False, limit=0):
+        '''
+        Queries the photos of a park.
+
+        Inputs:
+            parkunit (string) e.g. acad
+            labels (optional, int) cluster id
+            core (optional, bool) core photos of the clustering only
+            fields (optional, list) fields returned (full documents if None)
+            recent (bool) sort by upload date (most recent first)
+            limit (int) maximum number of photos (0 = no limit)
+        Output:
+            pymongo cursor
+        '''
+        query = {'parkunit':parkunit}
+        if labels is not None:
+            query['labels'] = int(labels)
+        if core is not None:
+            query['core'] = core
+
+        cursor = self.photos.find(query, projection(fields))
+        if recent:
+            cursor = cursor.sort('dateupload', pymongo.DESCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def count_photos(self, parkunit):
+        '''
+        Returns the number of photos of a park.
+        '''
+        return self.photos.count_documents({'parkunit':parkunit})
+
+    def find_top_photos(self, parkunit, labels):
+        '''
+        Returns the display pool of a cluster (list of photos, most recent first), None when it was not generated.
+
+        Inputs:
+            parkunit (string) e.g. acad
+            labels (int) cluster id
+        '''
+        result = self.top_photos.find_one({'parkunit':parkunit, 'labels':int(labels)}, {'_id':0, 'photos':1})
+        if result:
+            return result['photos']
+        return None
+
+    def find_clusters(self, parkunit, fields=None):
+        '''
+        Queries the clusters of a park (sorted by rank).
+        '''
+        return self.clusters.find({'parkunit':parkunit}, projection(fields)).sort('rank', pymongo.ASCENDING)
@@ -4,9 +4,15 @@ Parks and Park objects
 """
 import pymongo
 import nationalparks as usnp
+from nationalparks import tags
+from nationalparks import database
+from nationalparks import photos
 import json
 import folium
 import shapely.geometry
+import shapely.ops
+import shapely.prepared
+import shapely.vectorized
 import pandas as pd
 import geopandas as gpd
 import seaborn as sns
@@ -14,21 +20,108 @@ import matplotlib.pyplot as plt
 import os
 import numpy as np
 import re
+import hashlib
+import threading
+import time
 import matplotlib.cm as cm
 from sklearn.metrics import silhouette_samples, silhouette_score
 
+## url of the cluster markers served by the app (see get_map_html)
+MARKER_URL = '/static/img/markers/'
+
+## version of the park map rendering (to be incremented when show_park or get_map_html change their output)
+MAP_RENDER_VERSION = 1
+
+def get_map_renderer():
+    '''
+    Returns the parameters of the map rendering shared by all parks (see Park.get_map_etag).
+    '''
+    return {'version': MAP_RENDER_VERSION, 'folium': folium.__version__, 'marker_url': MARKER_URL}
+
+## park fields kept in memory by the registry (see Parks)
+REGISTRY_FIELDS = ['parkunit', 'parkname', 'state', 'latitude', 'longitude', 'photo_count']
+
 class Parks():
     """
     Parks object
+    In-memory registry of the parks (name <-> unit and basic metadata, see REGISTRY_FIELDS), loaded from
+    the parks collection with a single query and reloaded every ttl seconds, after invalidate or when the
+    data generation changes (see cache.DataGeneration).
+
+    Constructor:
+        inputs:
+            ttl (float) number of seconds the registry stays valid
     """
-    def __init__(self):
-        pass
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.__registry = None
+        self.__lock = threading.Lock()
+
+    def __load(self):
+        '''
+        Queries the parks once and indexes them by unit and by name.
+        '''
+        generation = usnp.data_generation.get()
+        parks = list(usnp.db.parks.find({}, database.projection(REGISTRY_FIELDS)).sort('parkname', pymongo.ASCENDING))
+        version = hashlib.sha1(json.dumps(parks, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return {
+            'time': time.time(),
+            'parks': parks,
+            'units': {x['parkunit']:x for x in parks},
+            'names': {x['parkname']:x['parkunit'] for x in parks},
+            'version': version,
+            'generation': generation
+            }
+
+    def __get_registry(self):
+        with self.__lock:
+            if (self.__registry is None or time.time() - self.__registry['time'] >= self.ttl
+                    or self.__registry['generation'] != usnp.data_generation.get()):
+                self.__registry = self.__load()
+            return self.__registry
+
+    def invalidate(self):
+        '''
+        Drops the registry (to be called after the parks collection is rewritten).
+        '''
+        with self.__lock:
+            self.__registry = None
+
+    def get_version(self):
+        '''
+        Returns a hash of the registry content (changes when a park is added, renamed or updated).
+        '''
+        return self.__get_registry()['version']
 
     def get_all_parkunits(self):
         '''
         Returns all park units (4 letters code).
         '''
-        return usnp.db.parks.find().distinct('parkunit')
+        return list(self.__get_registry()['units'].keys())
+
+    def get_all_parknames(self):
+        '''
+        Returns all park names (sorted).
+        '''
+        return list(self.__get_registry()['names'].keys())
+
+    def get_all_parks(self):
+        '''
+        Returns the registry fields of all parks (sorted by park name).
+        '''
+        return [dict(x) for x in self.__get_registry()['parks']]
+
+    def get_park_info(self, parkunit):
+        '''
+        Returns the registry fields of a park (None if the park does not exist).
+
+        Input:
+            parkunit (string) e.g. acad
+        Output:
+            dictionary (see REGISTRY_FIELDS)
+        '''
+        park = self.__get_registry()['units'].get(parkunit)
+        return dict(park) if park is not None else None
 
     def is_park_in_db(self, parkname):
         '''
@@ -39,11 +132,7 @@ class Parks():
         Output:
             True/False
         '''
-        query = usnp.db.parks.find_one({'parkname':parkname})
-        if query:
-            return True
-        else:
-            return False
+        return parkname in self.__get_registry()['names']
 
     def parkname_to_parkunit(self, parkname):
         '''
@@ -52,12 +141,16 @@ class Parks():
         Input:
             parkname (string) e.g. Acadia National Park
         Output:
-            parkunit (string) e.g. acad
+            parkunit (string) e.g. acad, None if the park does not exist
         '''
-        query = usnp.db.parks.find_one({'parkname':parkname})
-        if query:
-            return query['parkunit']
-        return None
+        return self.__get_registry()['names'].get(parkname)
+
+    def parkunit_to_parkname(self, parkunit):
+        '''
+        Convert park unit into park name (None if the park does not exist).
+        '''
+        park = self.__get_registry()['units'].get(parkunit)
+        return park['parkname'] if park is not None else None
 
 class Park():
     """
@@ -66,7 +159,9 @@ class Park():
     def __init__(self, parkunit):
 
         ## fetch park info
-        result = usnp.db.parks.find_one({'parkunit':parkunit})
+        result = usnp.db.find_park(parkunit)
+        if result is None:
+            raise ValueError('Unknown park unit: ' + str(parkunit))
         self.parkunit = parkunit
         self.parkname = result['parkname']
         self.state = result['state']
@@ -78,11 +173,9 @@ class Park():
         self.visitors = result['visitors']
         self.description = result['description']
 
-        ## boundaries
-        self.boundaries = json.loads(result['boundaries'])
+        ## boundaries (geojson is parsed on first access)
+        self._boundaries_json = result['boundaries']
         self.bbox = result['bbox']
-        self.bbox_points = self.__get_bbox_points()
-        self.polygons = self.__get_polygons()
 
         ## websites
         self.official_website = result['official_website']
@@ -90,16 +183,101 @@ class Park():
         
         ## photos
         self.photo_count = result['photo_count']
-    
-        ## clusters
-        self.clusters = self.__get_clusters()
-        self.cluster_count = len(self.clusters)
 
-        ## dbscan
-        self.dbscan = self.get_dbscan()
+        ## lazy attributes (computed on first access, then cached on the instance)
+        self._boundaries = None
+        self._bbox_points = None
+        self._polygons = None
+        self._park_area = None
+        self._clusters = None
+        self._dbscan = None
+        self._idf = None
+        self._tag_index = None
+        self._tag_index_loaded = False
+        self._map_html = None
+        self._map_etag = None
+
+    @property
+    def boundaries(self):
+        '''
+        Park boundaries (geojson dictionary).
+        '''
+        if self._boundaries is None:
+            self._boundaries = json.loads(self._boundaries_json)
+        return self._boundaries
+
+    @property
+    def bbox_points(self):
+        '''
+        Four corners of the park bounding box.
+        '''
+        if self._bbox_points is None:
+            self._bbox_points = self.__get_bbox_points()
+        return self._bbox_points
+
+    @property
+    def polygons(self):
+        '''
+        List of shapely polygons describing the park boundaries.
+        '''
+        if self._polygons is None:
+            self._polygons = self.__get_polygons()
+        return self._polygons
+
+    @property
+    def park_area(self):
+        '''
+        Prepared union of the park polygons, buffered by the boundary tolerance.
+        '''
+        if self._park_area is None:
+            area = shapely.ops.unary_union(self.polygons).buffer(self.__get_tolerance())
+            self._park_area = shapely.prepared.prep(area)
+        return self._park_area
+
+    @property
+    def clusters(self):
+        '''
+        Dataframe of the park clusters.
+        '''
+        if self._clusters is None:
+            self._clusters = self.__get_clusters()
+        return self._clusters
+
+    @property
+    def cluster_count(self):
+        '''
+        Number of clusters of the park.
+        '''
+        return len(self.clusters)
+
+    @property
+    def dbscan(self):
+        '''
+        DBSCAN information of the park.
+        '''
+        if self._dbscan is None:
+            self._dbscan = self.get_dbscan()
+        return self._dbscan
 
-        ## idf
-        self.idf = self.get_idf()
+    @property
+    def idf(self):
+        '''
+        Inverse Document Frequency of the park tags.
+        Requires a scan of all the park photos, hence only computed when needed (tf-idf).
+        '''
+        if self._idf is None:
+            self._idf = self.get_idf()
+        return self._idf
+
+    @property
+    def tag_index(self):
+        '''
+        Precomputed tag index of the park (None if the index was not generated).
+        '''
+        if not self._tag_index_loaded:
+            self._tag_index = tags.load_tag_index(self.parkunit)
+            self._tag_index_loaded = True
+        return self._tag_index
     
     def get_sw_ne(self):
         '''
@@ -165,10 +343,39 @@ class Park():
                 return True
         return False
 
-    def show_park(self):
+    def in_park_many(self, longitudes, latitudes):
+        '''
+        Vectorised version of in_park.
+        Points outside of the bounds of the park area are rejected before testing the polygons.
+
+        Inputs:
+            longitudes (array) longitude of each photo
+            latitudes (array) latitude of each photo
+        Output:
+            boolean numpy array, True when the photo is contained within the park (tolerance included)
+        '''
+        longitudes = np.asarray(longitudes, dtype=float)
+        latitudes = np.asarray(latitudes, dtype=float)
+        mask = np.zeros(longitudes.shape, dtype=bool)
+
+        ## bbox pre-rejection
+        min_lon, min_lat, max_lon, max_lat = self.park_area.context.bounds
+        candidates = (longitudes >= min_lon) & (longitudes <= max_lon) & (latitudes >= min_lat) & (latitudes <= max_lat)
+        if not candidates.any():
+            return mask
+
+        ## point in buffered polygons
+        mask[candidates] = shapely.vectorized.contains(self.park_area, longitudes[candidates], latitudes[candidates])
+        return mask
+
+    def show_park(self, tolerance=None, marker_url=None):
         '''
         Returns a folium map of the park.
         The map includes the park boundaries (blue), the park bounding box (red), and the park center (pin).
+
+        Inputs:
+            tolerance (optional, float) simplification tolerance of the boundaries (degrees), full geometry if None
+            marker_url (optional, string) url prefix of the marker images, images are embedded in the map if None
         '''
         ## create map
         start_coords = (self.latitude, self.longitude)
@@ -181,7 +388,7 @@ class Park():
         style_function = lambda x: {'fillColor': '#960808','fillOpacity': 0.1,'weight': 1.5, 'color':'#079305'}
         ## add park contour
         folium.GeoJson(
-            self.boundaries,
+            self.boundaries if tolerance is None else self.get_simplified_boundaries(tolerance),
             name='geojson',
             style_function=style_function
             ).add_to(folium_map)
@@ -198,11 +405,94 @@ class Park():
                 html = """<a href="{{ url_for('gallery') }}"> <button type="button" class="btn btn-primary">Small button</button></a>"""
                 popup = folium.Popup(html)
 
-                icon = folium.features.CustomIcon(icon_image=icon_path ,icon_size=size, icon_anchor=(size[0]//2, size[1]))
+                if marker_url is None:
+                    icon = folium.features.CustomIcon(icon_image=icon_path ,icon_size=size, icon_anchor=(size[0]//2, size[1]))
+                else:
+                    ## linked image (cached by the browser) instead of a base64 copy per marker
+                    icon = folium.DivIcon(
+                        html='<img src="{0}{1}.png" width="{2}" height="{3}">'.format(marker_url, row['rank'], size[0], size[1]),
+                        icon_size=size, icon_anchor=(size[0]//2, size[1]))
                 folium.Marker([row['latitude'], row['longitude']], icon=icon).add_to(folium_map)
         
         return folium_map
 
+    def get_map_tolerance(self):
+        '''
+        Simplification tolerance of the boundaries displayed on the park map.
+
+        Output:
+            float = max(park length (lat), park length (lon)) / 2000 (i.e. below one pixel at the initial zoom level)
+        '''
+        lat_diff = self.bbox['max_latitude']-self.bbox['min_latitude']
+        lon_diff = self.bbox['max_longitude']-self.bbox['min_longitude']
+        return max(lat_diff, lon_diff) / 2000.
+
+    def get_simplified_boundaries(self, tolerance, precision=5):
+        '''
+        Returns the park boundaries simplified with the given tolerance.
+        Each ring is simplified separately (rings of a polygon are not always holes, see __get_polygons),
+        rings smaller than the tolerance are dropped.
+
+        Inputs:
+            tolerance (float) maximum distance between the original and simplified boundaries (degrees)
+            precision (int) number of decimals kept in the coordinates
+        Output:
+            geojson dictionary (FeatureCollection)
+        '''
+        def simplify_rings(rings):
+            simplified = []
+            for ring in rings:
+                line = shapely.geometry.LineString(ring).simplify(tolerance, preserve_topology=True)
+                coords = np.round(np.asarray(line.coords), precision)
+                if coords.shape[0] >= 4:
+                    simplified.append(coords.tolist())
+            return simplified
+
+        features = self.boundaries['features'] if 'features' in self.boundaries else [self.boundaries]
+
+        simplified = []
+        for feature in features:
+            geometry = feature['geometry']
+            if geometry['type'] == 'Polygon':
+                coordinates = simplify_rings(geometry['coordinates'])
+            else:
+                coordinates = [x for x in map(simplify_rings, geometry['coordinates']) if x]
+            simplified.append({
+                'type': 'Feature',
+                'geometry': {'type': geometry['type'], 'coordinates': coordinates},
+                'properties': feature.get('properties', {})
+                })
+        return {'type': 'FeatureCollection', 'features': simplified}
+
+    def get_map_etag(self):
+        '''
+        Returns the ETag of the park map, derived from the data it displays and the rendering parameters
+        (the rendered html contains random element ids, hence differs between renderings of the same map).
+        '''
+        if self._map_etag is None:
+            digest = hashlib.sha1()
+            for value in [self.parkunit, json.dumps(get_map_renderer(), sort_keys=True), repr(self.get_map_tolerance()),
+                          self._boundaries_json, json.dumps(self.bbox, sort_keys=True), repr((self.latitude, self.longitude))]:
+                digest.update(str(value).encode('utf-8'))
+            digest.update(self.clusters[['rank', 'latitude', 'longitude']].to_numpy(dtype=float).tobytes())
+            self._map_etag = digest.hexdigest()
+        return self._map_etag
+
+    def get_map_html(self):
+        '''
+        Returns the html page of the park map displayed by the app and its ETag.
+        Boundaries are simplified and markers are linked from MARKER_URL.
+        The map is rendered once per Park object (i.e. once per cached park).
+
+        Output:
+            html (string)
+            etag (string) same value in every process for the same park data (see get_map_etag)
+        '''
+        if self._map_html is None:
+            html = self.show_park(tolerance=self.get_map_tolerance(), marker_url=MARKER_URL).get_root().render()
+            self._map_html = (html, self.get_map_etag())
+        return self._map_html
+
     def __get_bbox_points(self):
         '''
         Returns a list of four tuples corresponding to the four corners of the park bounding box.
@@ -232,28 +522,47 @@ class Park():
         lon_diff = self.bbox['max_longitude']-self.bbox['min_longitude']
         return min(lat_diff, lon_diff) / 500.
 
-    def get_photos(self):
+    def get_photos(self, fields=None):
         '''
         Queries photos of park from database.
 
+        Input:
+            fields (optional, list) fields to fetch (must include id), all fields if None
         Output:
             pandas Dataframe containing all photos taken whithin the boundaries of the park.
         '''
-        query = {
-            'parkunit': self.parkunit,
-        }
-
-        photos = list(usnp.db.photos.find(query))
+        photos = list(usnp.db.find_photos(self.parkunit, fields=fields))
         
-        df = pd.DataFrame(photos)
+        df = pd.DataFrame(photos, columns=fields)
         df = df.set_index('id', drop=True)
 
-        df['latitude'] = df['latitude'].astype(float)
-        df['longitude'] = df['longitude'].astype(float)
-        df['dateupload'] = df['longitude'].astype(int)
+        if fields is None:
+            df['latitude'] = df['latitude'].astype(float)
+            df['longitude'] = df['longitude'].astype(float)
+            df['dateupload'] = df['dateupload'].astype(int)
 
         return df
 
+    def get_photo_store(self, fields=None, labels=None, core=None):
+        '''
+        Queries photos of park from database into a compact columnar store (NumPy arrays, encoded tags).
+        Ids, coordinates and labels of all photos are memory-mapped from the coordinate file of the park
+        when it exists (see photos.write_coordinates) and holds as many photos as the collection (a file
+        left behind by an interrupted or remote reload is ignored), only the photos are counted.
+
+        Inputs:
+            fields (optional, list) fields to fetch (see photos.FIELDS), all fields of the store if None
+            labels (optional, int) cluster id
+            core (optional, bool) core photos of the clustering only
+        Output:
+            photos.PhotoStore
+        '''
+        if fields is not None and labels is None and core is None and set(fields) <= set(photos.COORDINATES_FIELDS):
+            store = photos.PhotoStore.from_coordinates(self.parkunit, fields=fields)
+            if store is not None and len(store) == usnp.db.count_photos(self.parkunit):
+                return store
+        return photos.PhotoStore.from_db(self.parkunit, fields=fields, labels=labels, core=core)
+
     def get_dbscan(self):
         '''
         Queries DBSCAN of park from database.
@@ -271,43 +580,33 @@ class Park():
 
         return dbscan
 
-    def get_top_photos(self, cluster_id, n_photos=50):
+    def get_top_photos(self, cluster_id, n_photos=50, seed=None):
         '''
-        Return the n_photos belonging to specified cluster sampled amongst the 500 most recent photos.
+        Return the n_photos belonging to specified cluster sampled amongst its most recent photos.
+        The precomputed display pool of the cluster is used (top_photos collection, see update_top_photos),
+        the pool is built from the 500 most recent photos when the pipeline has not generated it.
 
         Inputs:
             cluster_id (int) unique id of selected cluster
             n_photos (int) number of photos to be fetched
+            seed (optional, int) seed of the sample (same photos for the same seed, see cache.get_sample_seed)
         Outputs:
-            dictionary containing the information of the selected photos
+            list of dictionaries (id, url, title, ownername, dateupload) of the selected photos
         '''
-        ## query MongoDB
-        query = usnp.db.photos.find({
-            "$and": [
-                {'parkunit':self.parkunit},
-                {'labels':cluster_id}
-                ]
-            }).sort('dateupload', pymongo.DESCENDING).limit(500)
-
-        ## create dataframe
-        photos = list(query)
-        df = pd.DataFrame(photos)
+        ## display pool (a few kB)
+        pool = usnp.db.find_top_photos(self.parkunit, cluster_id)
+        if pool is None:
+            pool = photos.get_top_photo_pool(self.parkunit, cluster_id, size=500)
 
-        ## random sample
-        df = df.sample(n=min(n_photos,500))
-        df['title'] = df['title'].fillna("")
-
-        ## create url
-        df = df.set_index('id', drop=True)
-        df['url'] = "https://farm" + df['farm'].astype('str') + ".staticflickr.com/" + df['server'].astype('str')+"/"+df.index.astype('str')+"_"+df['secret']+".jpg"
-
-        return df.to_dict('records')
+        ## random sample (the pool order is fixed so that a seed always draws the same photos)
+        indices = np.random.RandomState(seed).choice(len(pool), size=min(n_photos, len(pool)), replace=False)
+        return [pool[i] for i in indices]
 
     def get_photo_count(self):
         '''
         Returns the number of photos taken in the park.
         '''
-        return self.get_photos()['_id'].count()
+        return usnp.db.count_photos(self.parkunit)
 
     def plot_all_photos(self, color_clusters=True):
         '''
@@ -322,13 +621,13 @@ class Park():
         df_boundaries.plot(alpha=0.2, ax=ax, color='grey')
 
         ## get photos
-        df_photos = self.get_photos()
+        df_photos = self.get_photo_store(fields=database.PHOTO_GEO_FIELDS).to_frame()
         top_labels = set(pd.Series(df_photos['labels']).value_counts().index.to_list())
 
         ## mapping label id with label rank
-        df_labels = df_photos.groupby(['labels']).count()[['_id']].sort_values(['_id'],ascending=False).reset_index()
+        df_labels = df_photos.groupby(['labels']).size().rename('count').sort_values(ascending=False).reset_index()
         df_labels.index +=1
-        df_labels.index = "Rank:" + df_labels.index.astype(str) + " (" + df_labels['_id'].astype(str) + " photos)"
+        df_labels.index = "Rank:" + df_labels.index.astype(str) + " (" + df_labels['count'].astype(str) + " photos)"
         mapping = {v:k for k,v in df_labels['labels'].to_dict().items()}
 
         df_photos['Cluster'] = df_photos['labels'].map(mapping)
@@ -371,13 +670,9 @@ class Park():
 
     def __get_clusters(self):
         '''
-        Queries information of all clusters of the park.
+        Queries information of all clusters of the park (sorted by rank).
         '''
-        query = {
-            'parkunit': self.parkunit,
-        }
-
-        clusters = list(usnp.db.clusters.find(query))
+        clusters = list(usnp.db.find_clusters(self.parkunit))
         df = pd.DataFrame(clusters)
         return df
 
@@ -392,12 +687,13 @@ class Park():
         '''
         return self.clusters.query('rank=='+ str(rank))['labels'].values[0]
 
-    def get_cluster_photos(self, cluster_rank):
+    def get_cluster_photos(self, cluster_rank, fields=None):
         '''
         Queries photos of park from database.
 
         Input:
             cluster_rank (int) rank of the selected cluster
+            fields (optional, list) fields to fetch (must include id), all fields if None
         Output:
             dataframe containing the cluster photos
         '''
@@ -405,14 +701,10 @@ class Park():
         cluster_id = self.convert_cluster_rank_to_id(cluster_rank)
 
         ## fetch photos associated to cluster
-        query = {
-            'parkunit': self.parkunit,
-            'labels': int(cluster_id)
-        }
-        photos = list(usnp.db.photos.find(query))
+        photos = list(usnp.db.find_photos(self.parkunit, labels=cluster_id, fields=fields))
         
         ## convert storage to dataframe
-        df = pd.DataFrame(photos)
+        df = pd.DataFrame(photos, columns=fields)
         df = df.set_index('id', drop=True)
 
         return df
@@ -429,6 +721,10 @@ class Park():
                 keys: (string) tags
                 values: (float) tf-idf
         '''
+        ## use precomputed index if available
+        if self.tag_index is not None:
+            return self.tag_index.get_top_tags(cluster_rank, top_count)
+
         ## compute tf-idf
         tf_idf = self.tf_idf(cluster_rank)
 
@@ -447,7 +743,7 @@ class Park():
         pattern = re.compile("^[a-zA-Z]+$")
 
         ## get all photos
-        df_all_photos = self.get_photos()
+        df_all_photos = self.get_photos(fields=database.PHOTO_TAG_FIELDS)
 
         ## cluster (document) count
         N = df_all_photos['labels'].nunique()
@@ -504,7 +800,7 @@ class Park():
         pattern = re.compile("^[a-zA-Z]+$")
 
         ## retrieve cluster photos
-        df = self.get_cluster_photos(cluster_rank)
+        df = self.get_cluster_photos(cluster_rank, fields=database.PHOTO_TAG_FIELDS)
 
         ## storage and counter
         tag_counters = {}
@@ -587,13 +883,13 @@ class Park():
         '''
 
         ## get photos and top labels
-        df_photos = self.get_photos()
+        df_photos = self.get_photo_store(fields=database.PHOTO_GEO_FIELDS).to_frame()
         top_labels = set(pd.Series(df_photos['labels']).value_counts().index.to_list())
 
         ## mapping label id with label rank
-        df_labels = df_photos.groupby(['labels']).count()[['_id']].sort_values(['_id'],ascending=False).reset_index()
+        df_labels = df_photos.groupby(['labels']).size().rename('count').sort_values(ascending=False).reset_index()
         df_labels.index +=1
-        df_labels.index = "Rank:" + df_labels.index.astype(str) + " (" + df_labels['_id'].astype(str) + " photos)"
+        df_labels.index = "Rank:" + df_labels.index.astype(str) + " (" + df_labels['count'].astype(str) + " photos)"
         mapping = {v:k for k,v in df_labels['labels'].to_dict().items()}
 
         ## create cluster and rank features
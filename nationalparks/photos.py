@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory photo store of a park (one NumPy array per field, dictionary-encoded tags)
+"""
+import os
+import itertools
+import sys
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import nationalparks as usnp
+from nationalparks import storage
+from nationalparks import database
+
+## fields of the store and dtype of their array (tags are dictionary-encoded)
+FIELDS = {
+    'id': np.int64,
+    'latitude': np.float64,
+    'longitude': np.float64,
+    'labels': np.int32,
+    'core': np.bool_,
+    'dateupload': np.int64,
+    'tags': None
+    }
+
+## value of the missing fields of a photo (no label = noise)
+MISSING = {'id': 0, 'latitude': np.nan, 'longitude': np.nan, 'labels': -1, 'core': False, 'dateupload': 0}
+
+## number of recent photos kept per cluster for display (see get_top_photo_pool)
+TOP_PHOTO_POOL_SIZE = 100
+
+## per-park coordinate files (memory-mapped, shared by processes through the page cache)
+COORDINATES_PATH = '../scrapper/data/coordinates'
+COORDINATES_DTYPE = np.dtype([('id', '<i8'), ('latitude', '<f8'), ('longitude', '<f8'), ('labels', '<i4')])
+COORDINATES_FIELDS = list(COORDINATES_DTYPE.names)
+
+class PhotoStore():
+    '''
+    Columnar store of the photos of a park.
+    Each field is a NumPy array (None when the field was not loaded). The tags of photo i are
+    vocabulary[tag_codes[tag_indptr[i]:tag_indptr[i + 1]]], each distinct tag is stored once.
+    Constructor:
+        inputs:
+            parkunit (string) e.g. acad
+            columns (dictionary) array of each loaded field (except tags)
+            vocabulary (optional, array) distinct tags
+            tag_indptr (optional, array) offsets of the tags of each photo
+            tag_codes (optional, array) tag codes (positions in the vocabulary)
+    Methods:
+        from_frames: build the store from dataframes
+        from_documents: build the store from photo documents
+        from_db: query the photos of a park
+        from_dataset: load the photos of a park from a pipeline dataset
+        from_coordinates: memory-map the coordinate file of a park
+        get_tags: return the tags of a photo
+        tag_matrix: return the sparse photo/tag count matrix
+        select: return the store restricted to some photos
+        to_frame: convert the store into a dataframe
+        memory_usage: return the size of the arrays
+    '''
+    def __init__(self, parkunit, columns, vocabulary=None, tag_indptr=None, tag_codes=None):
+        self.parkunit = parkunit
+        self.fields = [x for x in FIELDS if x in columns or (x == 'tags' and vocabulary is not None)]
+
+        self.id = columns.get('id')
+        self.latitude = columns.get('latitude')
+        self.longitude = columns.get('longitude')
+        self.labels = columns.get('labels')
+        self.core = columns.get('core')
+        self.dateupload = columns.get('dateupload')
+
+        self.vocabulary = vocabulary
+        self.tag_indptr = tag_indptr
+        self.tag_codes = tag_codes
+
+    def __len__(self):
+        if not self.fields:
+            return 0
+        if self.fields[0] == 'tags':
+            return len(self.tag_indptr) - 1
+        return len(getattr(self, self.fields[0]))
+
+    @classmethod
+    def from_frames(cls, parkunit, frames, fields=None):
+        '''
+        Builds the store from dataframes (e.g. chunks of a dataset), only the arrays are kept.
+
+        Inputs:
+            parkunit (string) e.g. acad
+            frames (iterable) dataframes of photos
+            fields (optional, list) fields to keep (all FIELDS if None)
+        Output:
+            PhotoStore
+        '''
+        fields = [x for x in FIELDS if fields is None or x in fields]
+        arrays = {x:[] for x in fields if x != 'tags'}
+        tokens, counts = [], []
+
+        for df in frames:
+            for field in arrays:
+                if field in df.columns:
+                    values = df[field].to_numpy()
+                    if field in ['labels', 'core', 'dateupload', 'id']:
+                        values = pd.Series(values).fillna(MISSING[field]).to_numpy()
+                    arrays[field].append(values.astype(FIELDS[field]))
+                else:
+                    arrays[field].append(np.full(df.shape[0], MISSING[field], dtype=FIELDS[field]))
+
+            ## split the tags (missing tags = no tag)
+            if 'tags' in fields:
+                tags = df['tags'].to_numpy(dtype=object) if 'tags' in df.columns else np.full(df.shape[0], None, dtype=object)
+                split = pd.Series(tags, dtype=object).str.split()
+                counts.append(split.str.len().fillna(0).to_numpy(dtype=np.int64))
+                tokens.append(np.array(list(itertools.chain.from_iterable(split.dropna().to_numpy())), dtype=object))
+
+        columns = {}
+        for field, values in arrays.items():
+            columns[field] = np.concatenate(values) if values else np.array([], dtype=FIELDS[field])
+
+        if 'tags' not in fields:
+            return cls(parkunit, columns)
+
+        ## intern the tags (one code per distinct tag, in order of first appearance)
+        tokens = np.concatenate(tokens) if tokens else np.array([], dtype=object)
+        codes, vocabulary = pd.factorize(tokens)
+        counts = np.concatenate(counts) if counts else np.array([], dtype=np.int64)
+        return cls(
+            parkunit,
+            columns,
+            vocabulary=np.asarray(vocabulary, dtype=object),
+            tag_indptr=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            tag_codes=codes.astype(np.int32))
+
+    @classmethod
+    def from_documents(cls, parkunit, documents, fields=None, chunksize=10000):
+        '''
+        Builds the store from photo documents (e.g. a pymongo cursor), converted by chunks.
+        '''
+        def chunks():
+            chunk = []
+            for document in documents:
+                chunk.append(document)
+                if len(chunk) == chunksize:
+                    yield pd.DataFrame(chunk)
+                    chunk = []
+            yield pd.DataFrame(chunk)
+        return cls.from_frames(parkunit, chunks(), fields)
+
+    @classmethod
+    def from_db(cls, parkunit, fields=None, labels=None, core=None):
+        '''
+        Queries the photos of a park (only the fields of the store are fetched).
+
+        Inputs:
+            parkunit (string) e.g. acad
+            fields (optional, list) fields to load (all FIELDS if None)
+            labels (optional, int) cluster id
+            core (optional, bool) core photos of the clustering only
+        Output:
+            PhotoStore
+        '''
+        fields = [x for x in FIELDS if fields is None or x in fields]
+        cursor = usnp.db.find_photos(parkunit, labels=labels, core=core, fields=fields)
+        return cls.from_documents(parkunit, cursor, fields)
+
+    @classmethod
+    def from_dataset(cls, folder, parkunit, fields=None, chunksize=10000):
+        '''
+        Loads the photos of a park from a pipeline dataset (e.g. ../scrapper/data/filtered), see storage.
+
+        Inputs:
+            folder (string)
+            parkunit (string) e.g. acad
+            fields (optional, list) fields to load (all FIELDS if None)
+            chunksize (int) number of rows read at once
+        Output:
+            PhotoStore
+        '''
+        fields = [x for x in FIELDS if fields is None or x in fields]
+        ## column pruning (parquet columns must exist)
+        path = storage.find_path(folder, parkunit)
+        columns = fields
+        if path is not None and path.endswith('.parquet'):
+            available = storage.pyarrow.parquet.ParquetFile(path).schema_arrow.names
+            columns = [x for x in fields if x in available]
+        frames = storage.read_chunks(folder, [parkunit], chunksize=chunksize, columns=columns)
+        return cls.from_frames(parkunit, frames, fields)
+
+    @classmethod
+    def from_coordinates(cls, parkunit, fields=None, path=COORDINATES_PATH):
+        '''
+        Memory-maps the coordinate file of a park (see write_coordinates), the arrays are read-only views
+        of the file. Returns None when the park has no coordinate file.
+
+        Inputs:
+            parkunit (string) e.g. acad
+            fields (optional, list) fields to keep (see COORDINATES_FIELDS), all if None
+            path (string) folder of the coordinate files
+        Output:
+            PhotoStore
+        '''
+        filename = get_coordinates_file(parkunit, path)
+        if not os.path.exists(filename):
+            return None
+        coordinates = np.load(filename, mmap_mode='r')
+        return cls(parkunit, {x:coordinates[x] for x in COORDINATES_FIELDS if fields is None or x in fields})
+
+    def get_tags(self, i):
+        '''
+        Returns the tags of the i-th photo.
+        '''
+        return self.vocabulary[self.tag_codes[self.tag_indptr[i]:self.tag_indptr[i + 1]]].tolist()
+
+    def tag_matrix(self):
+        '''
+        Returns the photo/tag count matrix (scipy csr matrix, one row per photo, one column per vocabulary tag).
+        '''
+        data = np.ones(len(self.tag_codes), dtype=np.int64)
+        matrix = scipy.sparse.csr_matrix(
+            (data, self.tag_codes, self.tag_indptr), shape=(len(self.tag_indptr) - 1, len(self.vocabulary)))
+        matrix.sum_duplicates()
+        return matrix
+
+    def select(self, mask):
+        '''
+        Returns a store containing the selected photos (boolean mask or indices), the vocabulary is shared.
+        '''
+        indices = np.arange(len(self))[mask]
+        columns = {x:getattr(self, x)[indices] for x in self.fields if x != 'tags'}
+        if 'tags' not in self.fields:
+            return PhotoStore(self.parkunit, columns)
+
+        starts, ends = self.tag_indptr[indices], self.tag_indptr[indices + 1]
+        tag_indptr = np.concatenate([[0], np.cumsum(ends - starts)]).astype(np.int64)
+        positions = np.repeat(starts - tag_indptr[:-1], ends - starts) + np.arange(tag_indptr[-1])
+        return PhotoStore(self.parkunit, columns, self.vocabulary, tag_indptr, self.tag_codes[positions])
+
+    def to_frame(self, fields=None):
+        '''
+        Converts the store into a dataframe (tags joined by spaces).
+        '''
+        fields = [x for x in self.fields if fields is None or x in fields]
+        data = {}
+        for field in fields:
+            if field == 'tags':
+                data[field] = [" ".join(self.get_tags(i)) for i in range(len(self))]
+            else:
+                data[field] = getattr(self, field)
+        return pd.DataFrame(data, columns=fields)
+
+    def memory_usage(self):
+        '''
+        Returns the size (bytes) of each field, the vocabulary strings included.
+        '''
+        usage = {x:getattr(self, x).nbytes for x in self.fields if x != 'tags'}
+        if 'tags' in self.fields:
+            usage['tags'] = self.tag_indptr.nbytes + self.tag_codes.nbytes + self.vocabulary.nbytes \
+                + sum(sys.getsizeof(x) for x in self.vocabulary)
+        return usage
+
+def get_coordinates_file(parkunit, path=COORDINATES_PATH):
+    return os.path.join(path, parkunit + '.npy')
+
+def write_coordinates(store, path=COORDINATES_PATH):
+    '''
+    Saves the ids, coordinates and labels of a store as a binary file (one record per photo, see COORDINATES_DTYPE).
+    The file is replaced atomically: processes mapping the former file keep reading it.
+
+    Inputs:
+        store (PhotoStore) photos containing the COORDINATES_FIELDS
+        path (string) output folder
+    Output:
+        file name
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    coordinates = np.empty(len(store), dtype=COORDINATES_DTYPE)
+    for field in COORDINATES_FIELDS:
+        coordinates[field] = getattr(store, field)
+
+    filename = get_coordinates_file(store.parkunit, path)
+    with open(filename + '.tmp', 'wb') as f:
+        np.save(f, coordinates)
+    os.replace(filename + '.tmp', filename)
+    return filename
+
+def update_coordinates(parkunits, path=COORDINATES_PATH, verbose=True):
+    '''
+    Writes the coordinate file of each park from the photos collection (to be run after each reload of the photos).
+
+    Output:
+        number of photos saved
+    '''
+    count = 0
+    for parkunit in parkunits:
+        store = PhotoStore.from_db(parkunit, fields=COORDINATES_FIELDS)
+        write_coordinates(store, path)
+        count += len(store)
+    if verbose:
+        print('... {0:,} coordinates saved for {1:,} parks'.format(count, len(parkunits)))
+    return count
+
+def get_photo_url(photo):
+    '''
+    Returns the url of a photo (farm, server, id and secret fields).
+    '''
+    return "https://farm{0}.staticflickr.com/{1}/{2}_{3}.jpg".format(photo['farm'], photo['server'], photo['id'], photo['secret'])
+
+def get_top_photo_pool(parkunit, labels, size=TOP_PHOTO_POOL_SIZE):
+    '''
+    Returns the display records (id, url, title, ownername, dateupload) of the most recent photos of a cluster.
+
+    Inputs:
+        parkunit (string) e.g. acad
+        labels (int) cluster id
+        size (int) number of photos
+    Output:
+        list of dictionaries (most recent first)
+    '''
+    cursor = usnp.db.find_photos(parkunit, labels=labels, fields=database.PHOTO_DISPLAY_FIELDS, recent=True, limit=size)
+    pool = []
+    for photo in cursor:
+        pool.append({
+            'id': int(photo['id']),
+            'url': get_photo_url(photo),
+            'title': photo['title'] if isinstance(photo.get('title'), str) else "",
+            'ownername': photo['ownername'] if isinstance(photo.get('ownername'), str) else "",
+            'dateupload': int(photo['dateupload'])
+            })
+    return sorted(pool, key=lambda x: (-x['dateupload'], x['id']))
+
+def build_top_photo_pools(parkunit, size=TOP_PHOTO_POOL_SIZE):
+    '''
+    Returns the documents of the top_photos collection of a park (one display pool per ranked cluster).
+    '''
+    documents = []
+    for cluster in usnp.db.find_clusters(parkunit, fields=['labels', 'rank']):
+        documents.append({
+            'parkunit': parkunit,
+            'labels': int(cluster['labels']),
+            'rank': int(cluster['rank']),
+            'photos': get_top_photo_pool(parkunit, cluster['labels'], size)
+            })
+    return documents
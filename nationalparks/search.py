@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory autocomplete index of the park names
+"""
+import re
+import bisect
+import difflib
+import hashlib
+import threading
+import unicodedata
+
+import nationalparks as usnp
+
+## characters removed or replaced before matching (see scrapper/scrap_parks.py)
+REPLACEMENTS = {'ʻ': '', '–': ' ', '-': ' ', '.': '', "'": ''}
+
+def normalize(text):
+    '''
+    Returns the searchable form of a text: lower case, no diacritics, words separated by single spaces.
+
+    Input:
+        text (string) e.g. Haleakalā National Park
+    Output:
+        string e.g. haleakala national park
+    '''
+    for old, new in REPLACEMENTS.items():
+        text = text.replace(old, new)
+    text = unicodedata.normalize('NFKD', text)
+    text = "".join(x for x in text if not unicodedata.combining(x))
+    return " ".join(re.findall(r'\w+', text.lower()))
+
+class ParkSearch():
+    """
+    Autocomplete index of the park names, built from the park registry (usnp.parks) and rebuilt when it changes.
+    Each name is indexed by every word suffix (e.g. "canyon national park" for Grand Canyon National Park)
+    in a sorted array searched by bisection. Queries without prefix match fall back to a fuzzy match.
+
+    Constructor:
+        inputs:
+            fuzzy_cutoff (float) minimum similarity (0-1) of a fuzzy match
+    Methods:
+        search: return the best matches of a query
+        get_names: return all park names (sorted)
+        get_etag: return the version of the index
+        invalidate: rebuild the index on next use
+    """
+    def __init__(self, fuzzy_cutoff=0.75):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.__index = None
+        self.__lock = threading.Lock()
+
+    def __build(self, version):
+        '''
+        Builds the sorted array of (key, position of the word, name) of the registered park names.
+        '''
+        names = sorted(usnp.parks.get_all_parknames())
+        keys = []
+        words = {}
+        for name in names:
+            tokens = normalize(name).split(' ')
+            for i in range(len(tokens)):
+                keys.append((" ".join(tokens[i:]), i, name))
+                words.setdefault(tokens[i], set()).add(name)
+        keys.sort()
+        etag = hashlib.sha1("\n".join(names).encode('utf-8')).hexdigest()
+        return {'names': names, 'keys': keys, 'prefixes': [x[0] for x in keys], 'words': words, 'etag': etag, 'version': version}
+
+    def __get_index(self):
+        version = usnp.parks.get_version()
+        with self.__lock:
+            if self.__index is None or self.__index['version'] != version:
+                self.__index = self.__build(version)
+            return self.__index
+
+    def get_names(self):
+        return list(self.__get_index()['names'])
+
+    def get_etag(self):
+        return self.__get_index()['etag']
+
+    def invalidate(self):
+        '''
+        Drops the index (rebuilt on next use).
+        '''
+        with self.__lock:
+            self.__index = None
+
+    def search(self, query, limit=10):
+        '''
+        Returns the park names matching a query, best matches first:
+            1. names starting with the query
+            2. names containing a word starting with the query
+            3. when nothing matches, names containing words close to the query words (typos)
+
+        Inputs:
+            query (string) e.g. yel, glacier bay, haleakala
+            limit (int) maximum number of names
+        Output:
+            list of park names
+        '''
+        index = self.__get_index()
+        query = normalize(query)
+        if not query:
+            return []
+
+        ## prefix matches (rank by position of the matching word, then name)
+        start = bisect.bisect_left(index['prefixes'], query)
+        matches = {}
+        for key, position, name in index['keys'][start:]:
+            if not key.startswith(query):
+                break
+            matches[name] = min(position, matches.get(name, position))
+        results = sorted(matches, key=lambda x: (matches[x], x))
+
+        ## fuzzy matches when nothing starts with the query (every word of the query must be close to a word of the name)
+        if not results:
+            candidates = None
+            for token in query.split(' '):
+                close = difflib.get_close_matches(token, index['words'].keys(), n=5, cutoff=self.fuzzy_cutoff)
+                names = set()
+                for word in close:
+                    names |= index['words'][word]
+                candidates = names if candidates is None else candidates & names
+            results = sorted(candidates or [])
+
+        return results[:limit]
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of the pipeline datasets (scrapper/data), Parquet with explicit dtypes or csv
+"""
+import os
+import glob
+import pandas as pd
+
+## parquet is optional (datasets are written as csv when pyarrow is missing)
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## format of the datasets written by the pipeline
+FORMAT = os.environ.get('NATIONALPARKS_STORAGE_FORMAT', 'parquet' if pyarrow is not None else 'csv')
+EXTENSIONS = {'parquet': '.parquet', 'csv': '.csv'}
+
+## explicit dtypes of the dataset columns (other columns are stored as strings)
+DTYPES = {
+    ## photos
+    'id': 'int64', 'owner': 'str', 'secret': 'str', 'server': 'int64', 'farm': 'int64',
+    'title': 'str', 'dateupload': 'int64', 'ownername': 'str', 'iconserver': 'int64', 'iconfarm': 'int64',
+    'views': 'int64', 'tags': 'str', 'latitude': 'float64', 'longitude': 'float64', 'context': 'int64',
+    'in_park': 'bool', 'parkunit': 'str', '_id': 'str',
+    ## flickr search results
+    'ispublic': 'int64', 'isfriend': 'int64', 'isfamily': 'int64', 'originalsecret': 'str', 'originalformat': 'str',
+    'accuracy': 'int64', 'place_id': 'str', 'woeid': 'str', 'geo_is_public': 'int64', 'geo_is_contact': 'int64',
+    'geo_is_friend': 'int64', 'geo_is_family': 'int64', 'machine_tags': 'str',
+    ## clustering
+    'labels': 'int64', 'core': 'bool', 'index': 'int64', 'photo_count': 'int64', 'top_20': 'bool', 'rank': 'int64',
+    'n_clusters': 'int64', 'eps': 'float64', 'min_samples': 'int64', 'scoring': 'str', 'metric': 'str',
+    ## tags
+    'top_tags': 'str', 'tag': 'str', 'count': 'int64', 'idf': 'float64'
+    }
+
+## csv columns parsed as strings (e.g. secrets made of digits only keep their leading zeros)
+CSV_DTYPES = {x:str for x, dtype in DTYPES.items() if dtype == 'str'}
+
+def apply_dtypes(df):
+    '''
+    Casts the known columns to their dtype and drops the index columns written by DataFrame.to_csv.
+    Integer and boolean columns containing missing values are kept as float/object.
+    '''
+    df = df.drop([x for x in df.columns if str(x).startswith('Unnamed:')], axis=1)
+    for column in df.columns:
+        dtype = DTYPES.get(column, 'str')
+        values = df[column]
+        if dtype == 'str':
+            if values.dtype == object or str(values.dtype) == 'str':
+                continue
+            df[column] = values.astype(object).where(values.isnull(), values.astype(str))
+        elif values.isnull().any():
+            if dtype == 'float64':
+                df[column] = values.astype(float)
+        else:
+            df[column] = values.astype(dtype)
+    return df
+
+def get_schema(columns):
+    '''
+    Returns the arrow schema of a list of columns (see DTYPES).
+    '''
+    types = {'int64': pyarrow.int64(), 'float64': pyarrow.float64(), 'bool': pyarrow.bool_(), 'str': pyarrow.string()}
+    return pyarrow.schema([(x, types[DTYPES.get(x, 'str')]) for x in columns])
+
+def get_path(folder, name, fmt=None):
+    '''
+    Returns the file of a dataset, e.g. get_path('../scrapper/data/clusters', 'acad') -> ../scrapper/data/clusters/acad.parquet
+    '''
+    return os.path.join(folder, name + EXTENSIONS[fmt or FORMAT])
+
+def find_path(folder, name):
+    '''
+    Returns the existing file of a dataset (parquet first), None if the dataset does not exist.
+    '''
+    for fmt in ['parquet', 'csv']:
+        path = get_path(folder, name, fmt)
+        if os.path.exists(path) and (fmt == 'csv' or pyarrow is not None):
+            return path
+    return None
+
+def exists(folder, name):
+    return find_path(folder, name) is not None
+
+def list_datasets(folder, suffix=''):
+    '''
+    Returns the names of the datasets stored in a folder (e.g. park units).
+
+    Inputs:
+        folder (string)
+        suffix (string) suffix of the names to keep (e.g. _ids)
+    Output:
+        sorted list of names
+    '''
+    names = set()
+    for fmt, extension in EXTENSIONS.items():
+        if fmt == 'parquet' and pyarrow is None:
+            continue
+        for path in glob.glob(os.path.join(folder, '*' + suffix + extension)):
+            names.add(os.path.basename(path)[:-len(extension)])
+    return sorted(names)
+
+def remove(folder, name):
+    '''
+    Removes every file of a dataset.
+    '''
+    for fmt in EXTENSIONS.keys():
+        path = get_path(folder, name, fmt)
+        if os.path.exists(path):
+            os.remove(path)
+
+def write_dataset(df, folder, name, fmt=None):
+    '''
+    Saves a dataframe (without its index) and removes the copies stored in other formats.
+
+    Output:
+        path of the file
+    '''
+    fmt = fmt or FORMAT
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    df = apply_dtypes(df.reset_index(drop=True))
+    remove(folder, name)
+    path = get_path(folder, name, fmt)
+    if fmt == 'parquet':
+        table = pyarrow.Table.from_pandas(df, schema=get_schema(df.columns), preserve_index=False)
+        pyarrow.parquet.write_table(table, path)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+def write_chunks(chunks, folder, name, columns, fmt=None):
+    '''
+    Saves a dataset chunk by chunk (bounded memory).
+
+    Inputs:
+        chunks (iterable) dataframes
+        folder (string)
+        name (string)
+        columns (list) columns of the dataset (missing columns are stored as null)
+    Output:
+        number of rows saved
+    '''
+    fmt = fmt or FORMAT
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    remove(folder, name)
+    path = get_path(folder, name, fmt)
+
+    count = 0
+    if fmt == 'parquet':
+        schema = get_schema(columns)
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            for df in chunks:
+                df = apply_dtypes(df.reindex(columns=columns).reset_index(drop=True))
+                writer.write_table(pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False))
+                count += df.shape[0]
+    else:
+        with open(path, 'w') as f:
+            pd.DataFrame(columns=columns).to_csv(f, index=False)
+            for df in chunks:
+                df.reindex(columns=columns).to_csv(f, index=False, header=False)
+                count += df.shape[0]
+    return count
+
+def get_columns(folder, name):
+    '''
+    Returns the columns of a dataset (without loading it).
+    '''
+    path = find_path(folder, name)
+    if path is None:
+        raise IOError('Dataset not found: ' + get_path(folder, name))
+    if path.endswith('.parquet'):
+        return list(pyarrow.parquet.read_schema(path).names)
+    return [x for x in pd.read_csv(path, nrows=0).columns if not str(x).startswith('Unnamed:')]
+
+def read_dataset(folder, name, columns=None):
+    '''
+    Loads a dataset.
+
+    Inputs:
+        folder (string)
+        name (string)
+        columns (optional, list) columns to load (all columns if None)
+    Output:
+        dataframe
+    '''
+    path = find_path(folder, name)
+    if path is None:
+        raise IOError('Dataset not found: ' + get_path(folder, name))
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    usecols = (lambda x: x in columns) if columns is not None else None
+    return apply_dtypes(pd.read_csv(path, index_col=None, header=0, usecols=usecols, dtype=CSV_DTYPES))
+
+def read_chunks(folder, names, chunksize=10000, columns=None, transform=None):
+    '''
+    Loads datasets by chunks (bounded memory).
+
+    Inputs:
+        folder (string)
+        names (list) names of the datasets
+        chunksize (int) number of rows per chunk
+        columns (optional, list) columns to load (all columns if None)
+        transform (optional, function) applied to each chunk: transform(df, name) -> df
+    Output:
+        generator of dataframes
+    '''
+    for name in names:
+        path = find_path(folder, name)
+        if path is None:
+            raise IOError('Dataset not found: ' + get_path(folder, name))
+        if path.endswith('.parquet'):
+            batches = pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns)
+            dfs = (x.to_pandas() for x in batches)
+        else:
+            usecols = (lambda x: x in columns) if columns is not None else None
+            dfs = (apply_dtypes(x) for x in pd.read_csv(path, index_col=None, header=0, usecols=usecols, dtype=CSV_DTYPES, chunksize=chunksize))
+        for df in dfs:
+            if transform is not None:
+                df = transform(df, name)
+            yield df
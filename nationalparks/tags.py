@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Tag index object (term counts, idf and tf-idf of photo tags per cluster)
+"""
+import pandas as pd
+import numpy as np
+import scipy.sparse
+import nationalparks as usnp
+from nationalparks import database
+from nationalparks import photos
+
+## tags kept in the index
+TAG_PATTERN = "^[a-zA-Z]+$"
+
+## term frequency normalisations
+TF_METHODS = ['term frequency', 'log normalization', 'double normalization', 'double normalization K']
+
+class TagIndex():
+    '''
+    Term/cluster count matrix of the photo tags of a park.
+    Constructor:
+        inputs:
+            parkunit (string) e.g. acad
+            labels (array) cluster ids (rows of the matrix)
+            ranks (array) cluster ranks (rows of the matrix)
+            terms (array) tags (columns of the matrix)
+            counts (scipy sparse matrix) tag occurrences per cluster
+            idf (array) inverse document frequency of each tag
+    Methods:
+        get_idf: return idf dictionary
+        get_tf: return term frequencies of a cluster
+        tf_idf: return tf-idf of a cluster
+        get_top_tags: return the top tags of a cluster
+    '''
+    def __init__(self, parkunit, labels, ranks, terms, counts, idf):
+        self.parkunit = parkunit
+        self.labels = np.asarray(labels)
+        self.ranks = np.asarray(ranks)
+        self.terms = np.asarray(terms, dtype=object)
+        self.counts = scipy.sparse.csr_matrix(counts)
+        self.idf = np.asarray(idf, dtype=float)
+        self.__rank_to_row = {int(r):i for i, r in enumerate(self.ranks) if r >= 0}
+
+    @classmethod
+    def from_photos(cls, parkunit, df_photos, ranks):
+        '''
+        Builds the index from a dataframe of photos containing the labels and tags features (see from_store).
+        '''
+        store = photos.PhotoStore.from_frames(parkunit, [df_photos], fields=['labels', 'tags'])
+        return cls.from_store(store, ranks)
+
+    @classmethod
+    def from_store(cls, store, ranks):
+        '''
+        Builds the index in a single pass over the park photos.
+        The tags of the store are already encoded: the cluster/term matrix is the product of the
+        cluster/photo indicator matrix and the photo/tag count matrix.
+
+        Inputs:
+            store (photos.PhotoStore) photos containing the labels and tags fields
+            ranks (dictionary) cluster rank of each cluster id
+        Output:
+            TagIndex
+        '''
+        ## one row per cluster (document)
+        labels, cluster_codes = np.unique(store.labels, return_inverse=True)
+        cluster_ranks = np.array([ranks.get(int(x), -1) for x in labels])
+
+        ## tags kept in the index (pattern tested once per distinct tag)
+        keep = np.flatnonzero(pd.Series(store.vocabulary, dtype=object).str.match(TAG_PATTERN, na=False).to_numpy(dtype=bool))
+        terms = store.vocabulary[keep]
+
+        ## sparse cluster/term count matrix
+        indicator = scipy.sparse.csr_matrix(
+            (np.ones(len(store), dtype=np.int64), (cluster_codes, np.arange(len(store)))),
+            shape=(len(labels), len(store)))
+        counts = (indicator @ store.tag_matrix()[:, keep]).tocsr()
+        counts.eliminate_zeros()
+
+        ## idf = cluster count / number of clusters containing the tag
+        document_count = np.diff(counts.tocsc().indptr)
+        idf = len(labels) / document_count.astype(float)
+
+        return cls(store.parkunit, labels, cluster_ranks, terms, counts, idf)
+
+    @classmethod
+    def from_records(cls, records):
+        '''
+        Builds the index from the documents of the tags collection (one per cluster).
+        '''
+        records = sorted(records, key=lambda x: x['labels'])
+        terms = {}
+        idf = []
+        rows, cols, data = [], [], []
+        for i, record in enumerate(records):
+            for tag, count, tag_idf in zip(record['tags'], record['counts'], record['idf']):
+                if tag not in terms:
+                    terms[tag] = len(terms)
+                    idf.append(tag_idf)
+                rows.append(i)
+                cols.append(terms[tag])
+                data.append(count)
+        counts = scipy.sparse.coo_matrix((data, (rows, cols)), shape=(len(records), len(terms)))
+        return cls(
+            records[0]['parkunit'] if records else None,
+            [x['labels'] for x in records],
+            [x['rank'] for x in records],
+            list(terms.keys()),
+            counts,
+            idf)
+
+    @classmethod
+    def from_frame(cls, df):
+        '''
+        Builds the index from its long format dataframe (see to_frame).
+        '''
+        records = []
+        for (parkunit, labels, rank), group in df.groupby(['parkunit', 'labels', 'rank']):
+            group = group[group['tag'].notnull()]
+            records.append({
+                'parkunit': parkunit,
+                'labels': int(labels),
+                'rank': int(rank),
+                'tags': group['tag'].tolist(),
+                'counts': group['count'].astype(int).tolist(),
+                'idf': group['idf'].astype(float).tolist()
+                })
+        return cls.from_records(records)
+
+    def to_records(self):
+        '''
+        Returns one document per cluster (term counts and idf).
+        '''
+        records = []
+        for i in range(self.counts.shape[0]):
+            row = self.counts.getrow(i)
+            records.append({
+                'parkunit': self.parkunit,
+                'labels': int(self.labels[i]),
+                'rank': int(self.ranks[i]),
+                'tags': self.terms[row.indices].tolist(),
+                'counts': row.data.astype(int).tolist(),
+                'idf': self.idf[row.indices].tolist()
+                })
+        return records
+
+    def to_frame(self):
+        '''
+        Returns the index as a long format dataframe (parkunit, labels, rank, tag, count, idf).
+        Clusters without tags are kept with an empty tag.
+        '''
+        counts = self.counts.tocoo()
+        df = pd.DataFrame({
+            'parkunit': self.parkunit,
+            'labels': self.labels[counts.row],
+            'rank': self.ranks[counts.row],
+            'tag': self.terms[counts.col],
+            'count': counts.data,
+            'idf': self.idf[counts.col]
+            })
+        empty = np.diff(self.counts.indptr) == 0
+        df_empty = pd.DataFrame({
+            'parkunit': self.parkunit,
+            'labels': self.labels[empty],
+            'rank': self.ranks[empty],
+            'tag': None,
+            'count': 0,
+            'idf': np.nan
+            })
+        return pd.concat([df, df_empty], axis=0, ignore_index=True)
+
+    def get_idf(self):
+        '''
+        Returns the Inverse Document Frequency of all the tags of the park.
+
+        Output:
+            dictionary of idf
+                key = tag
+                value = idf
+        '''
+        return dict(zip(self.terms, self.idf))
+
+    def __get_row(self, cluster_rank, max_df):
+        '''
+        Returns the term indices and counts of a cluster, without the tags with a frequency above max_df.
+        '''
+        i = self.__rank_to_row.get(int(cluster_rank))
+        if i is None:
+            return np.array([], dtype=int), np.array([], dtype=float)
+
+        row = self.counts.getrow(i)
+        indices, values = row.indices, row.data.astype(float)
+        if values.size == 0:
+            return indices, values
+
+        ## clear tags with high frequency
+        keep = values / values.sum() < max_df
+        return indices[keep], values[keep]
+
+    def get_tf(self, cluster_rank, method='term frequency', K=0.5, max_df=0.007):
+        '''
+        Computes term frequency of the photo tags whithin a cluster (see Park.get_tf).
+
+        Inputs:
+            cluster_rank (int)
+            method (string) one of TF_METHODS
+            K (optional, int) normalization factor
+        Output:
+            dictionary of term-frequencies
+                keys: tag (string)
+                values: tf (float)
+        '''
+        indices, values = self.__get_row(cluster_rank, max_df)
+        if values.size == 0:
+            return {}
+        return dict(zip(self.terms[indices], self.__normalize(values, method, K)))
+
+    def __normalize(self, values, method, K):
+        '''
+        Applies the term frequency normalisation to the cluster counts.
+        '''
+        if method == 'term frequency':
+            return values / values.sum()
+        elif method == 'log normalization':
+            return np.log(1 + values)
+        elif method == 'double normalization':
+            return 0.5 + 0.5 * values / values.max()
+        elif method == 'double normalization K':
+            return K + (1 - K) * values / values.max()
+        return values
+
+    def tf_idf(self, cluster_rank, method='double normalization'):
+        '''
+        Compute tf-idf for the selected cluster rank.
+
+        Input:
+            cluster_rank (int) rank of the cluster to be explored
+        Output:
+            dictionary of tf-idf values
+                keys: tags (string)
+                values: tf-idf (float)
+        '''
+        indices, values = self.__get_row(cluster_rank, 0.007)
+        if values.size == 0:
+            return {}
+        scores = self.__normalize(values, method, 0.5) * np.log(self.idf[indices])
+        return dict(zip(self.terms[indices], scores))
+
+    def get_top_tags(self, cluster_rank, top_count=20):
+        '''
+        Returns the most common tag for the selected cluster using tf-idf (see Park.get_top_tags).
+
+        Input:
+            cluster_rank (int) rank of the selected cluster to explore
+            top_count (int) number of tags to return
+        Output:
+            list of (tag, tf-idf)
+        '''
+        tf_idf = self.tf_idf(cluster_rank)
+        return sorted(tf_idf.items(), key=lambda x: x[1], reverse=False)[0:top_count]
+
+    def get_all_top_tags(self, top_count=20):
+        '''
+        Returns the top tags of every ranked cluster.
+
+        Output:
+            dictionary
+                keys: cluster rank (int)
+                values: list of (tag, tf-idf)
+        '''
+        return {rank:self.get_top_tags(rank, top_count) for rank in self.__rank_to_row.keys()}
+
+def build_tag_index(parkunit, ranks):
+    '''
+    Fetches the photos of a park once (labels and tags only, columnar store) and builds its tag index.
+
+    Inputs:
+        parkunit (string) e.g. acad
+        ranks (dictionary) cluster rank of each cluster id
+    Output:
+        TagIndex
+    '''
+    store = photos.PhotoStore.from_db(parkunit, fields=['labels', 'tags'])
+    return TagIndex.from_store(store, ranks)
+
+def load_tag_index(parkunit):
+    '''
+    Loads the precomputed tag index of a park from the tags collection.
+    Returns None when the park has no index.
+    '''
+    records = list(usnp.db.tags.find({'parkunit':parkunit}, {'_id':0}))
+    if not records:
+        return None
+    return TagIndex.from_records(records)
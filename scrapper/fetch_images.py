@@ -8,6 +8,24 @@ import flickrapi
 import nationalparks
 import pandas as pd
 from nationalparks import logger
+from nationalparks import storage
+
+import time
+import json
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+## extra fields requested with each search (dateupload is used as pagination cursor)
+EXTRAS = 'date_upload, owner_name, icon_server, original_format, geo, tags, machine_tags, views'
+
+## raw search results (datasets, journals and checkpoints)
+IMAGE_IDS_PATH = '../scrapper/data/image_ids/'
+## photos taken within the parks
+FILTERED_PATH = '../scrapper/data/filtered/'
+
+## errors worth retrying (API errors, connection errors, timeouts)
+RETRY_EXCEPTIONS = (flickrapi.exceptions.FlickrError, IOError)
 
 class FlickrImage():
     '''
@@ -52,12 +70,205 @@ class FlickrImage():
         self.neighbourhood = result['photo']['location']['neighbourhood']['_content']
         self.url = result['photo']['urls']['url'][0]['_content']
 
+class TokenBucket():
+    '''
+    Thread-safe token bucket shared by all the requests sent to the API.
+    Constructor:
+        inputs:
+            rate (float) number of tokens added per second
+            capacity (int) maximum number of tokens (burst size)
+    Methods:
+        acquire: wait until a token is available and consume it
+    '''
+    def __init__(self, rate=1.0, capacity=5):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.__tokens = float(capacity)
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Blocks until a token is available.
+        '''
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+
+class HarvestJournal():
+    '''
+    On-disk journal of the search results of a park, used to resume an interrupted harvest.
+    Each page of new photos is appended to <parkunit>_ids.jsonl (one photo per line) and the cursor
+    reached after the page is saved to <parkunit>_ids.checkpoint.
+    Constructor:
+        inputs:
+            parkunit (string) e.g. acad
+            path (string) folder of the journal
+    Methods:
+        exists: return True if an unfinished harvest is stored
+        load: return the stored photo ids and the last checkpoint
+        append: append a page of photos and save the checkpoint
+        to_dataset: convert the journal into the <parkunit>_ids dataset (see storage)
+        clear: remove the journal and its checkpoint
+    '''
+    def __init__(self, parkunit, path=IMAGE_IDS_PATH):
+        self.parkunit = parkunit
+        self.journal_file = os.path.join(path, parkunit + '_ids.jsonl')
+        self.checkpoint_file = os.path.join(path, parkunit + '_ids.checkpoint')
+        self.path = path
+        self.name = parkunit + '_ids'
+
+    def exists(self):
+        ## a journal without checkpoint is left by a crash before the first checkpoint
+        return os.path.exists(self.checkpoint_file) or os.path.exists(self.journal_file)
+
+    def load(self):
+        '''
+        Reads the ids stored in the journal and the last checkpoint.
+        A line left incomplete by a crash is truncated. Without checkpoint, the harvest restarts
+        from the first page and the photos already in the journal are skipped.
+
+        Output:
+            seen (set) photo ids already stored
+            checkpoint (dictionary) min_upload_date, page, requests
+        '''
+        seen = set()
+        checkpoint = {'min_upload_date':0, 'page':1, 'requests':0}
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as f:
+                checkpoint.update(json.load(f))
+
+        if os.path.exists(self.journal_file):
+            valid = 0
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    seen.add(json.loads(line)['id'])
+                    valid += len(line)
+            with open(self.journal_file, 'ab') as f:
+                f.truncate(valid)
+        return seen, checkpoint
+
+    def append(self, photos, checkpoint):
+        '''
+        Appends photos to the journal, then saves the checkpoint.
+        The journal is flushed to disk first: after a crash, the checkpoint never points past the stored photos.
+        '''
+        if photos:
+            with open(self.journal_file, 'a') as f:
+                for photo in photos:
+                    f.write(json.dumps(photo) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+        ## atomic update of the checkpoint
+        with open(self.checkpoint_file + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+    def __read(self, chunksize):
+        '''
+        Yields the photos of the journal by chunks.
+        '''
+        if not os.path.exists(self.journal_file):
+            return
+        chunk = []
+        with open(self.journal_file) as f:
+            for line in f:
+                chunk.append(json.loads(line))
+                if len(chunk) == chunksize:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def to_dataset(self, chunksize=10000):
+        '''
+        Streams the journal into the dataset of the park (parquet with explicit dtypes, see storage).
+
+        Output:
+            number of photos saved
+        '''
+        ## union of the fields (extras are not always returned)
+        columns = []
+        for chunk in self.__read(chunksize):
+            for photo in chunk:
+                for key in photo:
+                    if key not in columns:
+                        columns.append(key)
+
+        chunks = (pd.DataFrame.from_dict(chunk) for chunk in self.__read(chunksize))
+        return storage.write_chunks(chunks, self.path, self.name, columns)
+
+    def clear(self):
+        for filename in (self.journal_file, self.checkpoint_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
 class FlickrImageFinder():
-    def __init__(self, parks):
-        self.flickr = flickrapi.FlickrAPI(nationalparks.secrets.api_key, nationalparks.secrets.api_secret, format='parsed-json')
+    '''
+    Fetches the geotagged photos located within the bbox of each park.
+    Constructor:
+        inputs:
+            parks (list) Park objects
+            flickr (optional) Flickr client exposing photos.search (defaults to flickrapi.FlickrAPI)
+            rate (float) maximum number of API requests per second (all parks combined)
+            workers (int) number of parks fetched in parallel
+            max_retries (int) number of retries of a failed request
+            backoff (float) initial retry delay in seconds (doubled after each failure)
+    Methods:
+        filter_images: eliminate photos not taken inside parks
+        fetch_park: return the photos of one park
+        get_images: fetch and save the photos of every park
+    '''
+    def __init__(self, parks, flickr=None, rate=1.0, workers=4, max_retries=5, backoff=1.):
+        if flickr is None:
+            flickr = flickrapi.FlickrAPI(nationalparks.secrets.api_key, nationalparks.secrets.api_secret, format='parsed-json')
+        self.flickr = flickr
         self.parks = parks
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate=rate, capacity=max(1, workers))
+
+    def __call(self, method, **kwargs):
+        '''
+        Sends a rate limited request to the API. Failed requests are retried with exponential backoff.
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return method(**kwargs)
+            except RETRY_EXCEPTIONS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+                print('   ... request failed ({0}), retrying in {1:.1f}s'.format(e, delay))
+                time.sleep(delay)
+
+    def __search(self, park, min_upload_date, page):
+        '''
+        Returns one page of photos uploaded after min_upload_date within the bbox of the park.
+        '''
+        return self.__call(
+            self.flickr.photos.search,
+            privacy_filter=1,
+            has_geo=True,
+            bbox=park.get_bbox_string(),
+            page=page,
+            min_upload_date=str(min_upload_date),
+            sort='date-uploaded-asc',
+            extras=EXTRAS)
 
-    def filter_images(self, erase=True, progress=False):
+    def filter_images(self, erase=True):
         '''
         Eliminate photos not taken inside parks.
         '''
@@ -66,98 +277,118 @@ class FlickrImageFinder():
 
         ## iterate over all parks to filter images
         for park in self.parks:
-            if os.path.exists('../scrapper/data/filtered/' + park.parkunit + ".csv") and not erase:
+            if storage.exists(FILTERED_PATH, park.parkunit) and not erase:
                 image_counts[park.parkunit] = 'loaded'
-                print('... existing images retrieved for {}.csv'.format(park.parkunit))
+                print('... existing images retrieved for {}'.format(park.parkunit))
             else:
                 ## load original data
-                df = pd.read_csv('../scrapper/data/image_ids/' + park.parkunit + '_ids.csv')
+                df = storage.read_dataset(IMAGE_IDS_PATH, park.parkunit + '_ids')
 
                 if df.shape[0]>75000:
                     print('... trimming dataset to 75000 records for ' + park.parkunit)
                     df = df.head(75000)
 
-                df['in_park'] = False
-                if progress:
-                    df['in_park'] = df[['longitude', 'latitude']].progress_apply(lambda x: park.in_park(x), axis=1)
-                else:
-                    df['in_park'] = df[['longitude', 'latitude']].apply(lambda x: park.in_park(x), axis=1)
-                
+                df['in_park'] = park.in_park_many(df['longitude'].values, df['latitude'].values)
 
                 df = df[df['in_park']]
-                df.to_csv('../scrapper/data/filtered/' + park.parkunit + '.csv')
-                print('... {0} results saved in {1}_ids.csv'.format(df.shape[0], park.parkunit))
+                storage.write_dataset(df, FILTERED_PATH, park.parkunit)
+                print('... {0} results saved for {1}'.format(df.shape[0], park.parkunit))
+
+    def fetch_park(self, park, resume=True):
+        '''
+        Fetches all the photos located within the bbox of a park.
+        The search is limited to a few thousand results, the requests are therefore chained using
+        the upload date of the last photo received as cursor (dateupload is part of the extras).
+        Each page is appended to the journal of the park with its cursor, an interrupted harvest
+        restarts from the last checkpoint.
+
+        Input:
+            park (Park)
+            resume (bool) continue an unfinished harvest (restart from scratch otherwise)
+        Output:
+            HarvestJournal of the park
+        '''
+        journal = HarvestJournal(park.parkunit)
+        if not resume:
+            journal.clear()
+        if journal.exists():
+            print('... resuming image data for ' + park.parkunit)
+        else:
+            print('... fetching image data for ' + park.parkunit)
+
+        ## cutoff datetime to extend request beyond 4000 images
+        seen, checkpoint = journal.load()
+        min_upload_date = checkpoint['min_upload_date']
+        page = checkpoint['page']
+        requests = checkpoint['requests']
+
+        while True:
+            sets = self.__search(park, min_upload_date, page)
+            requests += 1
+            photos = sets['photos']['photo']
+            if len(photos) == 0:
+                break
 
-    def get_images(self, erase=True):
+            ## new images (the cursor is inclusive, pages overlap)
+            new_photos = [x for x in photos if x['id'] not in seen]
+            seen.update(x['id'] for x in new_photos)
+
+            ## move the cursor to the last upload date
+            ## (next page of the same cursor when a full page shares a single upload date)
+            cursor = max(int(x['dateupload']) for x in photos)
+            done = False
+            if cursor > min_upload_date:
+                min_upload_date, page = cursor, 1
+            elif page < int(sets['photos']['pages']):
+                page += 1
+            else:
+                done = True
+
+            ## store images and checkpoint
+            journal.append(new_photos, {'min_upload_date':min_upload_date, 'page':page, 'requests':requests})
+            if done:
+                break
+
+            if requests % 50 == 0:
+                print('   ... {0}: {1} requests, {2} images'.format(park.parkunit, requests, len(seen)))
+        return journal
+
+    def get_images(self, erase=True, resume=True):
         '''
         Fetch all the images that are located within the bbox of each park.
-        Saves image info into a csv file.
+        Parks are fetched concurrently, the request rate is shared.
+        Unfinished harvests are resumed from their journal unless resume is False.
+        Saves image info into the <parkunit>_ids dataset.
         '''
         ## store image counts for log
         image_counts = {}
 
-        ## iterate over all parks to get image ids
+        ## parks to fetch
+        to_fetch = []
         for park in self.parks:
-            if os.path.exists('../scrapper/data/image_ids/' + park.parkunit + '_ids.csv') and not erase:
+            journal = HarvestJournal(park.parkunit)
+            if storage.exists(journal.path, journal.name) and not erase and not journal.exists():
                 image_counts[park.parkunit] = 'loaded'
-                print('... existing data retrieved from {}_ids.csv'.format(park.parkunit))
+                print('... existing data retrieved from {}_ids'.format(park.parkunit))
             else:
-                
-                content = []
-                ## store number of total pages for API request
-                total_page = 0
-                ## cutoff datetime to extend request beyond 5000 images
-                min_upload_date=0
-
-                ## page 1
-                ## retrieve number of pages, first cutoff, headers
-                sets = self.flickr.photos.search(
-                            privacy_filter=1,
-                            has_geo=True,
-                            bbox=park.get_bbox_string(),
-                            page=1,
-                            sort='date-uploaded-asc',
-                            extras='date_upload, owner_name, icon_server, original_format, geo, tags, views')
-
-                ## get number of pages
-                total_page = sets['photos']['pages']
-
-                ## get first cut-off (shift by 1 hour)
-                min_upload_date=int(self.flickr.photos.getInfo(photo_id=sets['photos']['photo'][-1]['id'])['photo']['dates']['posted'])-60*60
-
-                ## get image count
-                print('... fetching image data for ' + park.parkunit)
-
-                ## store images
-                for photo in sets['photos']['photo']:
-                    content.append(photo)
-
-                for i in range(2,total_page+1):
-                    sets = self.flickr.photos.search(
-                        privacy_filter=1,
-                        has_geo=True,
-                        bbox=park.get_bbox_string(),
-                        page=1,
-                        max_upload_date=str(min_upload_date),
-                        sort='date-uploaded-asc',
-                        extras='date_upload, owner_name, icon_server, original_format, geo, tags, machine_tags, views')
-
-                    if len(sets['photos']['photo'])==0:
-                        break
-                    
-                    min_upload_date = int(self.flickr.photos.getInfo(photo_id=sets['photos']['photo'][-1]['id'])['photo']['dates']['posted'])-60*30
+                to_fetch.append(park)
 
-                    ## store images
-                    for photo in sets['photos']['photo']:
-                        content.append(photo)
-                    if i % 50 == 0:
-                        print('   ... {0}/{1} pages completed'.format(i, total_page))
-                image_counts[park.parkunit] = len(content)
+        ## iterate over all parks to get image ids
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch_park, park, resume):park for park in to_fetch}
+            for future in as_completed(futures):
+                park = futures[future]
+                try:
+                    journal = future.result()
+                except Exception as e:
+                    image_counts[park.parkunit] = 'error'
+                    print('... failed to fetch images for {0}, progress kept in {0}_ids.jsonl ({1})'.format(park.parkunit, e))
+                    continue
 
-                ## save to csv
-                df = pd.DataFrame.from_dict(content)
-                df.to_csv('../scrapper/data/image_ids/' + park.parkunit + '_ids.csv')
-                print('... {0} results saved in {1}_ids.csv'.format(len(content), park.parkunit))
+                ## save dataset
+                image_counts[park.parkunit] = journal.to_dataset()
+                journal.clear()
+                print('... {0} results saved in {1}_ids'.format(image_counts[park.parkunit], park.parkunit))
 
         ## update logger
-        logger.update_park_image_ids(image_counts)
\ No newline at end of file
+        logger.update_park_image_ids(image_counts)
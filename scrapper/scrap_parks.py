@@ -129,9 +129,7 @@ def get_photo_count(parkunit):
     '''
     Return the number of photos used for the clustering
     '''
-    photos = list(usnp.db.photos.find({'parkunit': parkunit}))
-    df = pd.DataFrame(photos)
-    return df._id.count()
+    return usnp.db.count_photos(parkunit)
 
 def get_geojson(parkunit):
     path = '../scrapper/data/geojson/' + parkunit + '.geojson'
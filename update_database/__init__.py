@@ -1,4 +1,7 @@
 from update_database import update_parks as upa
 from update_database import update_photos as uph
 from update_database import update_clusters as uc
-from update_database import update_tags as ut
\ No newline at end of file
+from update_database import update_tags as ut
+from update_database import update_increment as ui
+from update_database import update_maps as um
+from update_database import update_top_photos as utp
@@ -9,148 +9,228 @@ import nationalparks as usnp
 from nationalparks import database
 from nationalparks import clusters
 from nationalparks import parks
+from nationalparks import storage
+from nationalparks import photos
+from nationalparks import cache
+from update_database.update_top_photos import update_top_photos
+from update_database.update_maps import generate_maps
 
 import pandas as pd
 import json
 import glob
+import time
+import multiprocessing
+import concurrent.futures
 
-def create_clusters(verbose=True, erase=True):
+## output locations
+CLUSTER_PATH = '../scrapper/data/clusters'
+DBSCAN_PATH = '../scrapper/data/dbscan'
+PHOTO_PATH = '../scrapper/data/photo_clusters'
+
+## columns of the clustering in the photo_clusters datasets (the other photo fields are read from the photos collection)
+PHOTO_CLUSTER_COLUMNS = ['id', 'latitude', 'longitude', 'labels', 'core', 'parkunit']
+
+def join_photos(parkunit, df_geo):
     '''
-    Read image data from MongoDB, for each park perform DBSCAN with hyper-parameter tuning.
-    Save csv files (clusters, dbscan, photos)
+    Adds the photo fields (title, owner, tags, url fields...) to the clustered photos of a park.
+    The fields are read from the photos collection, i.e. the source of the clustering.
+
+    Inputs:
+        parkunit (string) e.g. acad
+        df_geo (dataframe) clustered photos (PHOTO_CLUSTER_COLUMNS)
+    Output:
+        dataframe (ValueError when a clustered photo is not in the collection)
     '''
-    ## create database clients
-    DB = database.DB()
-
-    ## store dataframe for each park
-    #data_clusters = []
-    #data_dbscan = []
-    #data_photos = []
+    hidden = {x:0 for x in PHOTO_CLUSTER_COLUMNS if x != 'id'}
+    df_photos = pd.DataFrame(list(usnp.db.photos.find({'parkunit':parkunit}, dict({'_id':0}, **hidden))))
+    if df_photos.empty:
+        df_photos = pd.DataFrame(columns=['id'])
+    df_photos = df_photos.drop_duplicates(subset='id')
+
+    df = df_geo.merge(df_photos, on='id', how='inner')
+    if df.shape[0] != df_geo.shape[0]:
+        raise ValueError('{0:,} clustered photos of {1} not found in the photos collection'.format(
+            df_geo.shape[0] - df.shape[0], parkunit))
+    return df
+
+def train_park(parkunit, verbose=True, n_jobs=-1, scoring='exact', metric='degrees'):
+    '''
+    Perform DBSCAN with hyper-parameter tuning for a single park.
+    Save datasets (clusters, dbscan, photos, see storage)
+
+    Inputs:
+        parkunit (string) e.g. acad
+        verbose (bool) print tuning progress
+        n_jobs (int) number of jobs used by DBSCAN
+        scoring (string) scoring mode of the hyper-parameter tuning (see clusters.SCORING_MODES)
+        metric (string) distance used by DBSCAN (see clusters.METRICS)
+    Output:
+        dictionary containing the park unit, the training status, the error (if any) and the wall time (s)
+    '''
+    start = time.time()
+    try:
+        ## create clusters
+        cluster = clusters.Clusters(parkunit)
+
+        ## train DBSCAN
+        df_geo, n_clusters, best_eps, best_min_samples = cluster.train_DBSCAN(verbose=verbose, n_jobs=n_jobs, scoring=scoring, metric=metric)
+
+        ## store info about dbscan
+        dbscan = pd.DataFrame([{'parkunit':parkunit, 'n_clusters':n_clusters+1, 'eps':best_eps, 'min_samples':best_min_samples, 'scoring':scoring, 'metric':metric}])
+        storage.write_dataset(dbscan, DBSCAN_PATH, parkunit)
+
+        ## store info about clusters
+        df_geo = df_geo.reset_index()
+        cluster = df_geo[['latitude', 'longitude', 'labels', 'id']].groupby(['labels']).agg({'latitude':'mean', 'longitude':'mean', 'id':'count'}).reset_index()
+
+        ## get cluster id and sort by popularity
+        labels_by_popularity = df_geo[['id', 'labels']].groupby(['labels']).count().sort_values(by='id', ascending=False).index
+        labels_by_popularity = labels_by_popularity[labels_by_popularity!=-1]
+        top_20 = labels_by_popularity[0:20]
+        labels_by_popularity = dict(zip(labels_by_popularity,range(1,len(labels_by_popularity)+1)))
+
+        ## create popularity feature
+        cluster['top_20'] = cluster['labels'].isin(top_20)
+        cluster['parkunit'] = parkunit
+        cluster['rank'] = cluster['labels'].map(labels_by_popularity)
+        cluster = cluster[~cluster['rank'].isnull()].reset_index()
+        cluster['rank'] = cluster['rank'].astype(int)
+        cluster = cluster[cluster['top_20']]
+        cluster = cluster.rename(columns={"id":"photo_count"})
+
+        ## save cluster dataframe
+        storage.write_dataset(cluster, CLUSTER_PATH, parkunit)
+
+        ## remove some photos
+        df_geo = df_geo[df_geo['labels'].isin(top_20)].assign(parkunit=parkunit)
+        storage.write_dataset(join_photos(parkunit, df_geo[PHOTO_CLUSTER_COLUMNS]), PHOTO_PATH, parkunit)
+
+        status, error = 'trained', None
+    except Exception as e:
+        status, error = 'failed', repr(e)
+
+    return {'parkunit':parkunit, 'status':status, 'error':error, 'time':time.time() - start}
+
+def get_parkunits_by_size():
+    '''
+    Returns all park units sorted by photo count (largest parks first).
+    '''
+    parks = list(usnp.db.parks.find({}, {'_id':0, 'parkunit':1, 'photo_count':1}))
+    parks = sorted(parks, key=lambda x: x.get('photo_count') or 0, reverse=True)
+    return [park['parkunit'] for park in parks]
 
+def create_clusters(verbose=True, erase=True, workers=None, scoring='exact', metric='degrees'):
+    '''
+    Read image data from MongoDB, for each park perform DBSCAN with hyper-parameter tuning.
+    Save datasets (clusters, dbscan, photos, see storage)
+
+    Parks are trained concurrently by a pool of worker processes (largest parks first).
+    A failure only affects its own park.
+
+    Inputs:
+        verbose (bool) print tuning progress
+        erase (bool) retrain parks for which data already exists
+        workers (int) number of worker processes (default: cpu count, 1: train in the current process)
+        scoring (string) scoring mode of the hyper-parameter tuning (see clusters.SCORING_MODES)
+        metric (string) distance used by DBSCAN, projected and haversine express eps in metres (see clusters.METRICS)
+    Output:
+        dataframe summarizing the status and wall time of each park
+    '''
     ## check if locations exists
-    cluster_path = '../scrapper/data/clusters'
-    dbscan_path = '../scrapper/data/dbscan'
-    photo_path = '../scrapper/data/photo_clusters'
-    if not os.path.exists(cluster_path):
-        os.mkdir(cluster_path)
-    if not os.path.exists(dbscan_path):
-        os.mkdir(dbscan_path)
-    if not os.path.exists(photo_path):
-        os.mkdir(photo_path)
+    for path in [CLUSTER_PATH, DBSCAN_PATH, PHOTO_PATH]:
+        if not os.path.exists(path):
+            os.mkdir(path)
 
-    ## train DBSCAN for each park
-    for parkunit in usnp.Parks().get_all_parkunits():
+    ## select parks to train
+    to_train = []
+    for parkunit in get_parkunits_by_size():
 
         ## check if data already exists
         train_dbscan = False
         if erase:
             train_dbscan = True
         else:
-            if not os.path.exists(os.path.join(cluster_path, parkunit + '.csv')):
-                train_dbscan = True
-            if not os.path.exists(os.path.join(dbscan_path, parkunit + '.csv')):
-                train_dbscan = True
-            if not os.path.exists(os.path.join(photo_path, parkunit + '.csv')):
-                train_dbscan = True
+            for path in [CLUSTER_PATH, DBSCAN_PATH, PHOTO_PATH]:
+                if not storage.exists(path, parkunit):
+                    train_dbscan = True
 
         if train_dbscan:
+            to_train.append(parkunit)
+        elif verbose:
+            print("...data already exists for " + parkunit)
 
-            ## create clusters
-            cluster = clusters.Clusters(parkunit)
-
-            ## train DBSCAN
-            df_geo, n_clusters, best_eps, best_min_samples = cluster.train_DBSCAN(verbose=verbose)
-
-            ## store info about dbscan
-            dbscan = pd.DataFrame([{'parkunit':parkunit, 'n_clusters':n_clusters+1, 'eps':best_eps, 'min_samples':best_min_samples}])
-            dbscan.to_csv(os.path.join(dbscan_path, parkunit + ".csv"))
-
-            ## store info about clusters
-            cluster = df_geo[['latitude', 'longitude', 'labels', '_id']].groupby(['labels']).agg({'latitude':'mean', 'longitude':'mean', '_id':'count'}).reset_index()
-
-            ## get cluster id and sort by popularity
-            labels_by_popularity = df_geo[['_id', 'labels']].groupby(['labels']).count().sort_values(by='_id', ascending=False).index 
-            labels_by_popularity = labels_by_popularity[labels_by_popularity!=-1]
-            top_20 = labels_by_popularity[0:20]
-            labels_by_popularity = dict(zip(labels_by_popularity,range(1,len(labels_by_popularity)+1)))
-
-            ## create popularity feature
-            cluster['top_20'] = cluster['labels'].isin(top_20)
-            cluster['parkunit'] = parkunit
-            cluster['rank'] = cluster['labels'].map(labels_by_popularity)
-            cluster = cluster[~cluster['rank'].isnull()].reset_index()
-            cluster['rank'] = cluster['rank'].astype(int)
-            cluster = cluster[cluster['top_20']]
-            cluster = cluster.rename(columns={"_id":"photo_count"})
-
-            ## save cluster dataframe
-            cluster.to_csv(os.path.join(cluster_path, parkunit + ".csv"))
-
-            ## remove some photos
-            df_geo = df_geo[df_geo['labels'].isin(top_20)]
-            df_geo.to_csv(os.path.join(photo_path, parkunit + ".csv"))
-        
-        else:
-            if verbose:
-                print("...data already exists for " + parkunit)
+    ## train DBSCAN for each park
+    workers = workers or os.cpu_count() or 1
+    start = time.time()
+    results = []
+    if workers == 1 or len(to_train) <= 1:
+        for parkunit in to_train:
+            results.append(train_park(parkunit, verbose=verbose, scoring=scoring, metric=metric))
+    else:
+        ## one core per park, processes are spawned (MongoClient is not fork-safe)
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [executor.submit(train_park, parkunit, verbose, 1, scoring, metric) for parkunit in to_train]
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print("... {0} {1} in {2:,.1f}s".format(result['parkunit'], result['status'], result['time']))
+
+    ## summary
+    summary = pd.DataFrame(results, columns=['parkunit', 'status', 'error', 'time'])
+    if verbose:
+        print(summary.sort_values(by='time', ascending=False).to_string(index=False))
+        print("... {0:,} parks trained in {1:,.1f}s ({2:,} failed)".format(
+            (summary['status']=='trained').sum(), time.time() - start, (summary['status']=='failed').sum()))
+    return summary
+
+def drop_columns(*columns):
+    '''
+    Returns a chunk transform dropping the index columns of the clustering.
+    '''
+    return lambda df, name: df.drop([x for x in columns if x in df.columns], axis=1)
 
-def update_database_clusters():
+def update_database_clusters(chunksize=10000):
     '''
-    Update MongoDB tables (clusters, photos, dbscan)
+    Update MongoDB tables (clusters, photos, dbscan, top_photos)
+    Each collection is streamed from its datasets into a staging collection swapped in at the end (see DB.bulk_load).
     '''
     
     ## create database clients
     DB = database.DB()
 
-    ## get paths to csv
-    cluster_path = '../scrapper/data/clusters'
-    dbscan_path = '../scrapper/data/dbscan'
-    photo_path = '../scrapper/data/photo_clusters'
-    cluster_files = glob.glob(cluster_path + '/*.csv')
-    dbscan_files = glob.glob(dbscan_path + '/*.csv')
-    photo_files = glob.glob(photo_path + '/*.csv')
-
-    ## store dataframe for each data types
-    clusters = []
-    dbscans = []
-    photos = []
-
-    for (cluster, dbscan, photo) in zip(cluster_files, dbscan_files, photo_files):
-        df_cluster = pd.read_csv(cluster, index_col=None, header=0)
-        df_dbscan = pd.read_csv(dbscan, index_col=None, header=0)
-        df_photo = pd.read_csv(photo, index_col=None, header=0)
-
-        clusters.append(df_cluster)
-        dbscans.append(df_dbscan)
-        photos.append(df_photo)
-
-        print('... information retrieved for ' + cluster.split('/')[-1])
-
-    ## compile info
-    df_clusters = pd.concat(clusters, axis=0, ignore_index=True)
-    df_dbscans = pd.concat(dbscans, axis=0, ignore_index=True)
-    df_photos = pd.concat(photos, axis=0, ignore_index=True)
-    print('... {:,} clusters found'.format(df_clusters.shape[0]))
-    print('... {:,} dbscans found'.format(df_dbscans.shape[0]))
-    print('... {:,} photos found'.format(df_photos.shape[0]))
-
-    del df_clusters['Unnamed: 0']
-    del df_dbscans['Unnamed: 0']
-    del df_clusters['index']
-
-    ## format dataframe into dictionary
-    clusters = df_clusters.to_dict(orient='records') 
-    dbscans = df_dbscans.to_dict(orient='records') 
-    photos = df_photos.to_dict(orient='records') 
-
-    ## clear existing content
-    DB.clusters.delete_many({})
-    DB.dbscan.delete_many({})
-    DB.photos.delete_many({})
+    ## get datasets
+    cluster_names = storage.list_datasets(CLUSTER_PATH)
+    dbscan_names = storage.list_datasets(DBSCAN_PATH)
+    photo_names = storage.list_datasets(PHOTO_PATH)
+
+    ## photo datasets must contain all the photo fields (the live collections are kept otherwise)
+    if not photo_names:
+        raise ValueError('No photo datasets found in ' + PHOTO_PATH)
+    for name in photo_names:
+        missing = [x for x in database.PHOTO_DISPLAY_FIELDS if x not in storage.get_columns(PHOTO_PATH, name)]
+        if missing:
+            raise ValueError('Dataset {0} lacks the photo fields {1}, retrain the park'.format(name, ", ".join(missing)))
 
     ## update database
-    DB.clusters.insert_many(clusters)
-    DB.dbscan.insert_many(dbscans)
-    DB.photos.insert_many(photos)
+    count = DB.bulk_load('clusters', storage.read_chunks(
+        CLUSTER_PATH, cluster_names, chunksize=chunksize, transform=drop_columns('index')))
+    print('... {:,} clusters found'.format(count))
+    count = DB.bulk_load('dbscan', storage.read_chunks(DBSCAN_PATH, dbscan_names, chunksize=chunksize))
+    print('... {:,} dbscans found'.format(count))
+    count = DB.bulk_load('photos', storage.read_chunks(PHOTO_PATH, photo_names, chunksize=chunksize))
+    print('... {:,} photos found'.format(count))
+
+    ## coordinate files of the clustered photos (plots, retraining)
+    photos.update_coordinates(photo_names)
+
+    ## display pools of the clusters (labels change with each training)
+    update_top_photos()
+
+    ## new data generation: caches of every process (app workers included) are rebuilt
+    cache.publish_update()
+
+    ## pre-rendered maps (cluster markers)
+    generate_maps()
 
     print("... information updated")
\ No newline at end of file
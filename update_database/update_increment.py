@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental update of the Cluster Database (new photos)
+"""
+import os, sys
+sys.path.append('..')
+
+import nationalparks as usnp
+from nationalparks import database
+from nationalparks import clusters
+from nationalparks import storage
+from nationalparks import photos
+from nationalparks import cache
+from update_database.update_photos import TO_DROP
+from update_database.update_clusters import CLUSTER_PATH, PHOTO_PATH
+from update_database.update_tags import generate_park_tags
+from update_database.update_maps import generate_maps
+
+import pandas as pd
+import numpy as np
+import pymongo
+import glob
+
+## raw photos of the parks (source of update_photos)
+FILTERED_PATH = '../scrapper/data/filtered'
+
+def append_dataset(df, folder, name):
+    '''
+    Appends rows to a dataset (created if missing); rows whose id is already stored are ignored.
+    '''
+    if storage.exists(folder, name):
+        df_stored = storage.read_dataset(folder, name)
+        df = pd.concat([df_stored, df[~df['id'].isin(df_stored['id'])]], axis=0, ignore_index=True)
+    storage.write_dataset(df, folder, name)
+
+def assign_new_photos(parkunit, df_new, max_noise=0.2, max_growth=0.25, verbose=True):
+    '''
+    Assigns newly ingested photos of a park to its existing DBSCAN clusters and updates MongoDB
+    (photos, clusters photo_count/centroid/rank/top tags, tag index, parks photo_count) and the map of the park.
+    The new photos are appended to the datasets of the full pipeline (filtered, photo_clusters, clusters,
+    tfidf and tags), so that a later full reload keeps them.
+    The update is skipped and a full retrain is requested when the drift exceeds a threshold.
+
+    Inputs:
+        parkunit (string) e.g. acad
+        df_new (dataframe) new photos taken within the park (format of scrapper/data/filtered)
+        max_noise (float) maximum share of new photos that do not belong to a ranked cluster
+        max_growth (float) maximum number of new photos relative to the clustered photos
+        verbose (bool)
+    Output:
+        dictionary summarizing the update (status: updated, unchanged or retrain)
+    '''
+    ## create database clients
+    DB = database.DB()
+
+    ## ignore photos that are already stored
+    existing = set(DB.photos.distinct('id', {'parkunit':parkunit}))
+    df_new = df_new[~df_new['id'].isin(existing)].drop_duplicates(subset='id')
+    df_raw = df_new
+    df_new = df_new.drop([x for x in TO_DROP if x in df_new.columns], axis=1)
+    summary = {'parkunit':parkunit, 'new_photos':df_new.shape[0], 'assigned':0, 'noise':0., 'growth':0.}
+    if df_new.empty:
+        summary['status'] = 'unchanged'
+        return summary
+
+    ## raw photos (kept by update_photos and by a full retrain)
+    append_dataset(df_raw, FILTERED_PATH, parkunit)
+
+    ## assign photos to existing clusters
+    cluster = clusters.Clusters(parkunit)
+    df_clusters = cluster.park.clusters
+    df_new = df_new.copy()
+    df_new['labels'] = cluster.assign_photos(df_new['longitude'].values, df_new['latitude'].values)
+    assigned = df_new['labels'].isin(df_clusters['labels'])
+
+    ## drift
+    clustered_count = int(df_clusters['photo_count'].sum()) if not df_clusters.empty else 0
+    summary['assigned'] = int(assigned.sum())
+    summary['noise'] = 1. - assigned.mean()
+    summary['growth'] = df_new.shape[0] / float(max(clustered_count, 1))
+    if summary['noise'] > max_noise or summary['growth'] > max_growth:
+        summary['status'] = 'retrain'
+        if verbose:
+            print("... drift detected for {0} (noise: {1:.1%}, growth: {2:.1%}), full retrain required".format(
+                parkunit, summary['noise'], summary['growth']))
+        return summary
+
+    ## insert photos of ranked clusters
+    df_assigned = df_new[assigned].copy()
+    df_assigned['parkunit'] = parkunit
+    df_assigned['core'] = False
+    if not df_assigned.empty:
+        DB.photos.insert_many(df_assigned.to_dict(orient='records'))
+        photos.update_coordinates([parkunit], verbose=False)
+        append_dataset(df_assigned, PHOTO_PATH, parkunit)
+
+    ## update cluster size, centroid and rank
+    df_stats = df_assigned.groupby('labels').agg({'latitude':['sum', 'count'], 'longitude':'sum'})
+    df_stats.columns = ['latitude_sum', 'count', 'longitude_sum']
+    df_clusters = df_clusters.set_index('labels')
+    df_clusters = df_clusters.join(df_stats, how='left').fillna({'latitude_sum':0., 'longitude_sum':0., 'count':0})
+    total = df_clusters['photo_count'] + df_clusters['count']
+    df_clusters['latitude'] = (df_clusters['latitude'] * df_clusters['photo_count'] + df_clusters['latitude_sum']) / total
+    df_clusters['longitude'] = (df_clusters['longitude'] * df_clusters['photo_count'] + df_clusters['longitude_sum']) / total
+    df_clusters['photo_count'] = total.astype(int)
+    df_clusters = df_clusters.sort_values(by=['photo_count', 'rank'], ascending=[False, True])
+    df_clusters['rank'] = np.arange(1, df_clusters.shape[0] + 1)
+
+    ## cluster dataset and tag index (top tags follow the new ranks and photos)
+    df_clusters = df_clusters.drop(['_id', 'latitude_sum', 'longitude_sum', 'count', 'top_tags'], axis=1, errors='ignore').reset_index()
+    storage.write_dataset(df_clusters, CLUSTER_PATH, parkunit)
+    df_clusters, tag_index = generate_park_tags(df_clusters)
+
+    cluster_requests = []
+    for i, row in df_clusters.iterrows():
+        query = {'parkunit':parkunit, 'labels':int(row['labels'])}
+        cluster_requests.append(pymongo.UpdateOne(query, {'$set': {
+            'latitude':float(row['latitude']), 'longitude':float(row['longitude']),
+            'photo_count':int(row['photo_count']), 'rank':int(row['rank']), 'top_tags':row['top_tags']}}))
+    if cluster_requests:
+        DB.clusters.bulk_write(cluster_requests, ordered=False)
+    DB.tags.delete_many({'parkunit':parkunit})
+    records = tag_index.to_records()
+    if records:
+        DB.tags.insert_many(records)
+    DB.parks.update_one({'parkunit':parkunit}, {'$inc': {'photo_count':int(df_assigned.shape[0])}})
+
+    ## display pools of the park (new photos are the most recent)
+    pools = photos.build_top_photo_pools(parkunit)
+    DB.top_photos.delete_many({'parkunit':parkunit})
+    if pools:
+        DB.top_photos.insert_many(pools)
+
+    ## new data generation: caches of every process (app workers included) are rebuilt
+    cache.publish_update()
+
+    ## pre-rendered map (built after the new generation is published)
+    generate_maps(parkunits=[parkunit], verbose=False)
+
+    summary['status'] = 'updated'
+    if verbose:
+        print("... {0}: {1:,} new photos, {2:,} assigned to existing clusters".format(parkunit, summary['new_photos'], summary['assigned']))
+    return summary
+
+def update_new_photos(path='../scrapper/data/new', max_noise=0.2, max_growth=0.25, verbose=True):
+    '''
+    Incremental update for every park with new photos (one dataset per park, e.g. ../scrapper/data/new/acad.parquet).
+    Parks with too much drift are listed for a full retrain (create_clusters + update_database_clusters).
+
+    Output:
+        dataframe summarizing the update of each park
+    '''
+    summaries = []
+    for parkunit in storage.list_datasets(path):
+        df = storage.read_dataset(path, parkunit)
+        summaries.append(assign_new_photos(parkunit, df, max_noise=max_noise, max_growth=max_growth, verbose=verbose))
+
+    summary = pd.DataFrame(summaries, columns=['parkunit', 'status', 'new_photos', 'assigned', 'noise', 'growth'])
+    if verbose and (summary['status']=='retrain').any():
+        print("... full retrain required for: " + ", ".join(summary.loc[summary['status']=='retrain', 'parkunit']))
+    return summary
+
+if __name__ == "__main__":
+    ## assign new photos
+    update_new_photos()
+
+    print("... Clusters updated")
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-renders the park maps served by the app (run by update_clusters, outdated maps are rendered live by the app)
+"""
+import os, sys
+sys.path.append('..')
+
+import nationalparks as usnp
+from nationalparks.parks import get_map_renderer
+
+import gzip
+import json
+
+## brotli is optional (gzip artifacts only when missing)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+## folder served by the app
+MAP_PATH = '../app/static/maps'
+
+def write_file(filename, data):
+    '''
+    Writes bytes to a file atomically (readers never see a partial map).
+    '''
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(filename + '.tmp', filename)
+
+def generate_maps(path=MAP_PATH, parkunits=None, verbose=True):
+    '''
+    Renders the map of every park once (simplified boundaries, linked markers, see Park.get_map_html)
+    and saves the html with its gzip and brotli precompressed versions:
+        <parkunit>.html, <parkunit>.html.gz, <parkunit>.html.br
+    A manifest (manifest.json) stores the ETag and size of each artifact, with the data generation and the
+    renderer they were built with (the app renders the map live when they no longer match, see app/views.py).
+
+    Inputs:
+        path (string) output folder
+        parkunits (optional, list) parks to render, all parks if None
+        verbose (bool)
+    Output:
+        manifest (dictionary)
+    '''
+    if not os.path.exists(path):
+        os.mkdir(path)
+
+    ## existing manifest (partial rebuild)
+    manifest_file = os.path.join(path, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    if parkunits is None:
+        parkunits = usnp.parks.get_all_parkunits()
+
+    renderer = get_map_renderer()
+    for parkunit in parkunits:
+        ## generation read before the park data (a concurrent update leaves the map outdated)
+        generation = usnp.db.get_generation()
+        park = usnp.Park(parkunit)
+        html, etag = park.get_map_html()
+        html = html.encode('utf-8')
+
+        ## identity, gzip and brotli artifacts
+        artifacts = {'identity': html, 'gzip': gzip.compress(html, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            artifacts['br'] = brotli.compress(html, quality=11)
+
+        extensions = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+        for encoding, data in artifacts.items():
+            write_file(os.path.join(path, parkunit + '.html' + extensions[encoding]), data)
+
+        manifest[parkunit] = {
+            'etag': etag,
+            'generation': generation,
+            'renderer': renderer,
+            'sizes': {encoding:len(data) for encoding, data in artifacts.items()}
+            }
+        if verbose:
+            print('... map rendered for {0} ({1})'.format(parkunit, ', '.join(
+                '{0}: {1:,.0f} kB'.format(encoding, len(data) / 1024.) for encoding, data in artifacts.items())))
+
+    ## save manifest
+    write_file(manifest_file, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+if __name__ == "__main__":
+    ## render maps
+    generate_maps(parkunits=sys.argv[1:] or None)
+
+    print("... Maps updated")
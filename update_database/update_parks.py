@@ -5,7 +5,9 @@ Updates National Parks database
 import os, sys
 sys.path.append('..')
 
+import nationalparks as usnp
 from nationalparks import database
+from nationalparks import cache
 from scrapper import scrap_parks
 
 import pandas as pd
@@ -26,6 +28,12 @@ def update_parks():
     ## update database
     ## index, state, latitude, longitude, date, surface_acres, surface_km2, visitors, description
     DB.parks.insert_many(records)
+
+    ## create indexes (all collections)
+    DB.ensure_indexes()
+
+    ## new data generation: caches of every process (app workers included) are rebuilt
+    cache.publish_update()
     
 
 if __name__ == "__main__":
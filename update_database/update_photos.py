@@ -6,55 +6,56 @@ import os, sys
 sys.path.append('..')
 
 from nationalparks import database
+from nationalparks import storage
+from nationalparks import photos
+from nationalparks import cache
 
 import pandas as pd
 import json
 import glob
 
-def update_photos():
+## features dropped before insertion
+TO_DROP = [
+    'Unnamed: 0','Unnamed: 0.1','ispublic',
+    'isfriend','isfamily','accuracy',
+    'place_id','woeid','originalsecret',
+    'originalformat','machine_tags','geo_is_public',
+    'geo_is_contact','geo_is_friend','geo_is_family'
+]
+
+def format_photos(df, name):
+    '''
+    Adds the park unit (from the dataset name) and drops unecessary features.
+    '''
+    ## add parkunit
+    df['parkunit'] = name
+
+    ## drop unecessary features
+    return df.drop([x for x in TO_DROP if x in df.columns], axis=1)
+
+def update_photos(chunksize=10000):
+    '''
+    Reloads the photos collection from the filtered datasets (see storage).
+    The datasets are streamed by chunks into a staging collection swapped in at the end (see DB.bulk_load).
+    '''
 
     ## create database clients
     DB = database.DB()
 
-    ## get paths to csv
+    ## get datasets
     path = '../scrapper/data/filtered' # use your path
-    all_files = glob.glob(path + '/*.csv')
+    names = storage.list_datasets(path)
+    print('... {:,} files found'.format(len(names)))
 
-    ## store dataframe for each park
-    li = []
-
-    for filename in all_files:
-        df = pd.read_csv(filename, index_col=None, header=0)
-
-        ## add parkunit
-        df['parkunit'] = filename.split('/')[-1].replace('.csv',"")
-
-        ## drop unecessary features
-        to_drop = [
-            'Unnamed: 0','Unnamed: 0.1','ispublic',
-            'isfriend','isfamily','accuracy',
-            'place_id','woeid','originalsecret',
-            'originalformat','machine_tags','geo_is_public',
-            'geo_is_contact','geo_is_friend','geo_is_family'
-        ]
-        df = df.drop(to_drop, axis=1)
-
-        li.append(df)
-
-        print('... information retrieved for ' + filename)
-
-    ## compile info
-    df_photos = pd.concat(li, axis=0, ignore_index=True)
-    print('... {:,} photos found'.format(df_photos.shape[0]))
-
-    ## format dataframe into dictionary
-    data = df_photos.to_dict(orient='records') 
+    ## update database
+    count = DB.bulk_load('photos', storage.read_chunks(path, names, chunksize=chunksize, transform=format_photos))
+    print('... {:,} photos loaded'.format(count))
 
-    ## clear existing content
-    DB.photos.delete_many({})
+    ## coordinate files used by the clustering
+    photos.update_coordinates(names)
 
-    ## update database
-    DB.photos.insert_many(data)
+    ## new data generation: caches of every process (app workers included) are rebuilt
+    cache.publish_update()
 
 if __name__ == "__main__":
     ## update parks
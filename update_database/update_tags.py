@@ -9,76 +9,81 @@ import nationalparks as usnp
 from nationalparks import database
 from nationalparks import clusters
 from nationalparks import parks
+from nationalparks import tags
+from nationalparks import storage
+from nationalparks import cache
 
 import pandas as pd
 import json
 import glob
 
-def generate_tags():
-    '''
-    Generate most relevant tags
+## dataset locations
+CLUSTER_PATH = '../scrapper/data/clusters'
+TFIDF_PATH = '../scrapper/data/tfidf'
+INDEX_PATH = '../scrapper/data/tags'
+
+def generate_park_tags(df_cluster):
     '''
-    
-    ## create database clients
-    DB = database.DB()
+    Builds the tag index of a park and the top tags of its clusters.
+    Saves the cluster (tfidf) and tag index datasets.
 
-    ## get paths to csv
-    cluster_path = '../scrapper/data/clusters'
-    save_path  = '../scrapper/data/tfidf'
-    cluster_files = glob.glob(cluster_path + '/*.csv')
+    Inputs:
+        df_cluster (dataframe) clusters of a single park (format of scrapper/data/clusters)
+    Output:
+        tuple (clusters with their top tags, TagIndex)
+    '''
+    df_cluster = df_cluster.copy()
+    parkunit = df_cluster['parkunit'].values[0]
 
-    ## store dataframe for each data types
-    clusters = []
+    ## build tag index (one photo query per park)
+    ranks = dict(zip(df_cluster['labels'].astype(int), df_cluster['rank'].astype(int)))
+    tag_index = tags.build_tag_index(parkunit, ranks)
+    top_tags = tag_index.get_all_top_tags()
 
-    for cluster in cluster_files:
-        df_cluster = pd.read_csv(cluster, index_col=0, header=0)
-        df_cluster['top_tags'] = ''
+    df_cluster['top_tags'] = df_cluster['rank'].apply(lambda x: ";".join([x[0] for x in top_tags.get(x, [])]))
 
-        parkunit = df_cluster['parkunit'].values[0]
-        park = usnp.Park(parkunit)
+    ## save cluster dataframe and tag index
+    storage.write_dataset(df_cluster, TFIDF_PATH, parkunit)
+    storage.write_dataset(tag_index.to_frame(), INDEX_PATH, parkunit)
+    return df_cluster, tag_index
 
-        df_cluster['top_tags'] = df_cluster['rank'].apply(lambda x: ";".join([x[0] for x in park.get_top_tags(x)]))
+def generate_tags():
+    '''
+    Generate most relevant tags.
+    The tag index of each park (term counts and idf per cluster) is built from a single photo query
+    and saved along with the top tags of every cluster.
+    '''
 
-        print('... tf-idf computed for ' + cluster.split('/')[-1])
+    ## get datasets
+    cluster_names = storage.list_datasets(CLUSTER_PATH)
 
-        ## save cluster dataframe
-        df_cluster.to_csv(os.path.join(save_path, parkunit + ".csv"))
+    for cluster in cluster_names:
+        generate_park_tags(storage.read_dataset(CLUSTER_PATH, cluster))
+        print('... tf-idf computed for ' + cluster)
 
-def update_database_clusters():
+def update_database_clusters(chunksize=10000):
     '''
-    Update MongoDB tables clusters
+    Update MongoDB tables clusters and tags
+    Each collection is streamed into a staging collection swapped in at the end (see DB.bulk_load).
     '''
     
     ## create database clients
     DB = database.DB()
 
-    ## get paths to csv
-    cluster_path = '../scrapper/data/tfidf'
-    cluster_files = glob.glob(cluster_path + '/*.csv')
-
-    ## store dataframe for each data types
-    clusters = []
-
-    for cluster in cluster_files:
-        df_cluster = pd.read_csv(cluster, index_col=None, header=0)
-
-        clusters.append(df_cluster)
-
-        print('... information retrieved for ' + cluster.split('/')[-1])
+    ## get datasets
+    cluster_names = storage.list_datasets(TFIDF_PATH)
 
-    ## compile info
-    df_clusters = pd.concat(clusters, axis=0, ignore_index=True)
-    print('... {:,} clusters found'.format(df_clusters.shape[0]))
-
-    del df_clusters['Unnamed: 0']
-
-    ## format dataframe into dictionary
-    clusters = df_clusters.to_dict(orient='records') 
+    ## update database
+    count = DB.bulk_load('clusters', storage.read_chunks(TFIDF_PATH, cluster_names, chunksize=chunksize))
+    print('... {:,} clusters found'.format(count))
 
-    ## clear existing content
-    DB.clusters.delete_many({})
+    ## update tag index (one park at a time)
+    index_names = storage.list_datasets(INDEX_PATH)
+    records = (tags.TagIndex.from_frame(storage.read_dataset(INDEX_PATH, x)).to_records() for x in index_names)
+    DB.bulk_load('tags', records)
+    print('... {:,} tag indexes found'.format(len(index_names)))
 
-    ## update database
-    DB.clusters.insert_many(clusters)
+    ## new data generation: caches of every process (app workers included) are rebuilt
+    cache.publish_update()
 
     print("... information updated")
\ No newline at end of file
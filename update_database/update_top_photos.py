@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Updates the display pools of the clusters (run by update_clusters after each training)
+"""
+import os, sys
+sys.path.append('..')
+
+import nationalparks as usnp
+from nationalparks import database
+from nationalparks import photos
+from nationalparks import cache
+
+def update_top_photos(parkunits=None, size=photos.TOP_PHOTO_POOL_SIZE):
+    '''
+    Rebuilds the top_photos collection: for each cluster, the display records (url, title, owner)
+    of its most recent photos. The web tier samples the scene photos from these pools.
+
+    Inputs:
+        parkunits (optional, list) parks to update, all parks if None (full reload)
+        size (int) number of photos per pool
+    '''
+
+    ## create database clients
+    DB = database.DB()
+
+    if parkunits is None:
+        ## full reload (swapped in at the end, see DB.bulk_load)
+        pools = (photos.build_top_photo_pools(x, size) for x in usnp.parks.get_all_parkunits())
+        count = DB.bulk_load('top_photos', pools)
+    else:
+        count = 0
+        for parkunit in parkunits:
+            pools = photos.build_top_photo_pools(parkunit, size)
+            DB.top_photos.delete_many({'parkunit':parkunit})
+            if pools:
+                DB.top_photos.insert_many(pools)
+            count += len(pools)
+    print('... {:,} photo pools found'.format(count))
+
+    ## new data generation: caches of every process (app workers included) are rebuilt
+    cache.publish_update()
+
+if __name__ == "__main__":
+    ## update pools
+    update_top_photos(parkunits=sys.argv[1:] or None)
+
+    print("... Photo pools updated")
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+"""
+Production entry point (pre-fork server, see gunicorn.conf.py):
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+from app import app
+from app.warmup import warm_up
+
+## warm caches before accepting traffic (in the master process when the app is preloaded)
+if os.environ.get('NATIONALPARKS_WARM_UP', '1') != '0':
+    warm_up()